@@ -0,0 +1,182 @@
+"""Compares the API's throughput with and without its two concurrency
+settings, at the same number of worker processes (one):
+
+  - config.gunicorn["threads"]: how many requests a worker serves at once
+      (1 for gunicorn's "sync" worker class, more for "gthread")
+  - config.db["concurrent_queries"]: whether independent lookups within
+      a request are sent at the same time on separate pooled connections
+
+No database is needed: psycopg2 is replaced with a fake that answers
+each query with synthetic rows after sleeping for a simulated network
+round trip, and requests are sent straight to the WSGI application from
+as many threads as the worker would have. The response cache is turned
+off and every request asks for a different paper or author, so each one
+reaches the database.
+
+Usage (from the repository's root directory):
+
+  python benchmarks/concurrency.py [--latency MS] [--requests N] [--threads N]
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# config.py reads the database credentials from the environment
+os.environ.setdefault("RX_DBHOST", "localhost")
+os.environ.setdefault("RX_DBUSER", "rxivist")
+os.environ.setdefault("RX_DBPASSWORD", "rxivist")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bottle
+import psycopg2
+import psycopg2.extensions
+
+import config
+
+AUTHORS_PER_PAPER = 10
+PAPERS_PER_AUTHOR = 50
+
+def _article(i):
+  "The url, title, collection, posted date and DOI of a paper, then its ranks."
+  return (f"https://www.biorxiv.org/{i}", f"Paper {i}", "genomics", datetime.date(2020, 1, 1),
+    f"10.1101/{i}", i + 1, i + 2, i + 3, i // 2, "genomics", 10000 - i, 500, 30)
+
+# (pattern, function of the query's parameters returning its rows)
+RESPONSES = [
+  (r"FROM data_version", lambda params: [(1, None)]),
+  (r"LEFT JOIN article_publications", lambda params: [(
+    f"https://www.biorxiv.org/{params[0]}", "A paper", "genomics", datetime.date(2019, 5, 1),
+    "10.1101/1", "The abstract", "Nature", "10.1038/1", "biorxiv",
+    datetime.datetime(2020, 1, 2), 10, 20, 30, 4, "genomics", 5000, 400, 30)]),
+  (r"FROM article_authors as aa", lambda params: [
+    (article, article * 100 + n, f"Author {n}", "The Institute", None)
+    for article in params[0] for n in range(AUTHORS_PER_PAPER)]),
+  (r"FROM authors WHERE id", lambda params: [("Dr. Prolific", "The Institute", "")]),
+  (r"WHERE article_authors.author=%s", lambda params: [
+    (i,) + _article(i) for i in range(PAPERS_PER_AUTHOR)]),
+  (r"FROM author_ranks WHERE", lambda params: [(12, False, 999999)]),
+  (r"FROM author_ranks_category", lambda params: [(3, True, 888888, "genomics")]),
+]
+
+class FakeConnection(object):
+  "A psycopg2 connection whose every query takes a simulated round trip."
+  latency = 0.002
+
+  def __init__(self, *args, **kwargs):
+    self.prepared = set()
+    self.statements = {}
+    self.closed = 0
+    self.status = psycopg2.extensions.STATUS_READY
+    self.autocommit = True
+
+  def set_session(self, autocommit=None, **kwargs):
+    self.autocommit = autocommit
+
+  def cursor(self, name=None, **kwargs):
+    return FakeCursor(self)
+
+  def rollback(self):
+    pass
+
+  def commit(self):
+    pass
+
+  def close(self):
+    self.closed = 1
+
+class FakeCursor(object):
+  "Answers queries from RESPONSES after a simulated round trip."
+  def __init__(self, connection):
+    self.connection = connection
+    self.rows = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def execute(self, query, params=None):
+    time.sleep(FakeConnection.latency)
+    prepare = re.match(r"PREPARE (\w+) AS (.*)", query, re.S)
+    if prepare is not None:
+      self.connection.statements[prepare.group(1)] = prepare.group(2)
+      return
+    execute = re.match(r"EXECUTE (\w+)", query)
+    if execute is not None:
+      query = self.connection.statements[execute.group(1)]
+    self.rows = []
+    for pattern, rows in RESPONSES:
+      if re.search(pattern, query, re.S):
+        self.rows = rows(params)
+        break
+
+  def fetchall(self):
+    rows, self.rows = self.rows, []
+    return rows
+
+psycopg2.connect = FakeConnection
+bottle.run = lambda *args, **kwargs: None # (main.py starts the server when imported)
+config.response_cache["enabled"] = False
+
+with contextlib.redirect_stdout(sys.stderr):
+  import main
+
+APP = bottle.default_app()
+COUNTER = iter(range(1, 10 ** 9))
+COUNTER_LOCK = threading.Lock()
+
+def request(path_template):
+  """Sends one request for a new paper or author straight to the WSGI app,
+  and returns how long it took."""
+  with COUNTER_LOCK:
+    path = path_template.format(next(COUNTER))
+  environ = {
+    "REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": "",
+    "SERVER_NAME": "localhost", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+    "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(), "wsgi.errors": sys.stderr,
+  }
+  status = []
+  started = time.perf_counter()
+  b"".join(APP(environ, lambda s, headers, exc_info=None: status.append(s)))
+  elapsed = time.perf_counter() - started
+  if not status[0].startswith("200"):
+    raise RuntimeError(f"{path} returned {status[0]}")
+  return elapsed
+
+def run(path_template, threads, concurrent_queries, total):
+  """Serves the given number of requests with the given settings, and
+  returns the requests per second and the mean latency in ms."""
+  config.db["concurrent_queries"] = concurrent_queries
+  request(path_template) # (warm up the pool)
+  started = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    latencies = list(executor.map(lambda _: request(path_template), range(total)))
+  elapsed = time.perf_counter() - started
+  return total / elapsed, 1000 * sum(latencies) / len(latencies)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--latency", type=float, default=2.0, help="simulated round trip per query, in ms")
+  parser.add_argument("--requests", type=int, default=400, help="requests per measurement")
+  parser.add_argument("--threads", type=int, default=4, help="threads per worker, for the gthread mode")
+  args = parser.parse_args()
+  FakeConnection.latency = args.latency / 1000
+
+  print("| Endpoint | Worker | Concurrent lookups | Requests/s | Mean latency (ms) |")
+  print("| --- | --- | --- | --- | --- |")
+  for name, path in [("/v1/papers/<id>", "/v1/papers/{}"), ("/v1/authors/<id>", "/v1/authors/{}")]:
+    for threads in [1, args.threads]:
+      for concurrent in [False, True]:
+        # (the API's log messages, like new connections, go to stderr)
+        with contextlib.redirect_stdout(sys.stderr):
+          rate, latency = run(path, threads, concurrent, args.requests)
+        worker = "sync" if threads == 1 else f"gthread, {threads} threads"
+        print(f"| `{name}` | {worker} | {'yes' if concurrent else 'no'} | {rate:.0f} | {latency:.1f} |")
@@ -0,0 +1,102 @@
+"""Measures the memory and time it takes to build a page of paper search
+results from its database rows: the models, their authors and the json()
+output of each, as endpoints.paper_query() and main.py do. No database is
+needed; the rows are synthetic.
+
+Usage (from the repository's root directory):
+
+  python benchmarks/serialization.py [REVISION ...]
+
+Each REVISION is a git revision whose models.py should be measured, or "."
+for the working tree (the default). Everything else models.py imports
+comes from the working tree.
+"""
+import argparse
+import datetime
+import inspect
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+# config.py reads the database credentials from the environment
+os.environ.setdefault("RX_DBHOST", "localhost")
+os.environ.setdefault("RX_DBUSER", "rxivist")
+os.environ.setdefault("RX_DBPASSWORD", "rxivist")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+class FakeConnection(object):
+  "Answers the author lookup for a page of papers with synthetic rows."
+  def __init__(self, authors_per_paper):
+    self.authors_per_paper = authors_per_paper
+
+  def read(self, query, params=None):
+    return [
+      (article, article * 100 + n, f"Author {article}-{n}", "The Institute", "")
+      for article in sorted(params[0])
+      for n in range(self.authors_per_paper)
+    ]
+
+def load_models(revision):
+  """Loads models.py as of the given git revision (or the working tree,
+  if the revision is ".") as a module."""
+  if revision == ".":
+    with open(os.path.join(ROOT, "models.py")) as f:
+      source = f.read()
+  else:
+    source = subprocess.run(["git", "show", f"{revision}:models.py"], cwd=ROOT,
+      check=True, capture_output=True, text=True).stdout
+  module = types.ModuleType("models")
+  exec(compile(source, f"{revision}:models.py", "exec"), module.__dict__)
+  return module
+
+def build_page(models, rows, connection):
+  """Builds the JSON-ready dicts for a page of search results, the way
+  endpoints.paper_query() did in the measured revision."""
+  if "as_json" in inspect.signature(models.get_authors_bulk).parameters:
+    authors = models.get_authors_bulk([r[1] for r in rows], connection, as_json=True)
+  else:
+    authors = models.get_authors_bulk([r[1] for r in rows], connection)
+  return [models.SearchResultArticle(r, connection, authors[r[1]]).json() for r in rows]
+
+def measure(revision, papers, authors_per_paper, repeat):
+  """Reports the peak memory and the time it takes to build one page of
+  results with the given revision's models. The time is the average over
+  the fastest of five rounds of building the page repeat times, which is
+  the least disturbed by whatever else the machine is doing."""
+  models = load_models(revision)
+  connection = FakeConnection(authors_per_paper)
+  rows = [
+    (5000 - i, i, f"https://www.biorxiv.org/{i}", f"Paper {i}", "abstract", "genomics",
+      datetime.date(2020, 1, 1), f"10.1101/{i}", "biorxiv", i + 1)
+    for i in range(papers)
+  ]
+  build_page(models, rows, connection) # (warm up)
+
+  tracemalloc.start()
+  page = build_page(models, rows, connection)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  del page
+
+  rounds = []
+  for _ in range(5):
+    started = time.perf_counter()
+    for _ in range(repeat):
+      build_page(models, rows, connection)
+    rounds.append((time.perf_counter() - started) / repeat)
+  elapsed = min(rounds)
+  print(f"{revision}: {peak / 1024:.0f} KiB peak, {elapsed * 1000:.2f} ms per page")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("revisions", nargs="*", default=["."])
+  parser.add_argument("--papers", type=int, default=250)
+  parser.add_argument("--authors", type=int, default=10, help="authors per paper")
+  parser.add_argument("--repeat", type=int, default=100, help="pages built per timing round")
+  args = parser.parse_args()
+  for rev in args.revisions:
+    measure(rev, args.papers, args.authors, args.repeat)
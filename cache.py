@@ -0,0 +1,402 @@
+"""In-process caching of API responses.
+
+Most of the data served by the API changes only when the spider finishes a
+run, so responses for the busiest endpoints are kept in memory and served
+again until they expire, rather than rebuilt from the database every time a
+request gets past the CDN. Calling bump_data_version() in the database
+increases the generation number in the data_version table; when the API
+notices a new generation, everything cached is thrown out. Since the data
+can also change without the number being bumped, nothing is kept for
+longer than config.data_version["max_age"] seconds either way.
+
+The same generation number (plus the current max_age period) is used to
+build ETags, so clients and CDN edges that already have a response can
+revalidate it without the API touching the database.
+
+Compressed copies of cached responses are stored alongside them (see
+compression.py), so each is compressed at most once per encoding.
+"""
+from collections import OrderedDict
+import functools
+import hashlib
+import threading
+import time
+from urllib.parse import urlencode
+
+import bottle
+
+import compression
+import config
+import helpers
+
+class ResponseCache(object):
+  """A size-bounded, least-recently-used store of serialized responses,
+  each of which expires after its own time-to-live.
+
+  """
+  def __init__(self, max_bytes):
+    """Sets up an empty cache.
+
+    Arguments:
+      - max_bytes: Roughly how much memory the cached responses are
+          allowed to take up before the least recently used ones are evicted.
+
+    """
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict() # key -> (expiration time, body, headers, {encoding: compressed body})
+    self.size = 0
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key):
+    """Looks up a cached response.
+
+    Arguments:
+      - key: The normalized request, as built by request_key()
+
+    Returns:
+      - A tuple of the response body and a list of (name, value) header
+          pairs, or None if there is no unexpired entry for the key.
+
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] < time.time():
+        self._remove(key)
+        self.expirations += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[1], entry[2]
+
+  def put(self, key, body, headers, ttl):
+    """Stores a response, evicting the least recently used entries if
+    there isn't room for it.
+
+    Arguments:
+      - key: The normalized request, as built by request_key()
+      - body: The serialized response
+      - headers: A list of (name, value) pairs to send with the response
+      - ttl: How many seconds the entry should be served before it expires
+
+    """
+    size = len(key) + len(body)
+    if size > self.max_bytes:
+      return
+    with self.lock:
+      if key in self.entries:
+        self._remove(key)
+      while self.size + size > self.max_bytes:
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+      self.entries[key] = (time.time() + ttl, body, headers, {})
+      self.size += size
+
+  def variant(self, key, encoding):
+    """Looks up the compressed copy of a cached response.
+
+    Arguments:
+      - key: The normalized request, as built by request_key()
+      - encoding: The compression used, such as "gzip"
+
+    Returns:
+      - The compressed body, or None if it hasn't been stored.
+
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      return entry[3].get(encoding)
+
+  def add_variant(self, key, encoding, body):
+    """Stores the compressed copy of a cached response next to it, if
+    the response is still cached.
+
+    Arguments:
+      - key: The normalized request, as built by request_key()
+      - encoding: The compression used, such as "gzip"
+      - body: The compressed response
+
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or encoding in entry[3]:
+        return
+      entry[3][encoding] = body
+      self.size += len(body)
+      while self.size > self.max_bytes and len(self.entries) > 1:
+        oldest = next(iter(self.entries))
+        if oldest == key:
+          self.entries.move_to_end(key)
+          continue
+        self._remove(oldest)
+        self.evictions += 1
+
+  def clear(self):
+    """Drops every cached response."""
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+  def _remove(self, key):
+    _, body, _, variants = self.entries.pop(key)
+    self.size -= len(key) + len(body) + sum(len(v) for v in variants.values())
+
+  def stats(self):
+    """Reports how effective the cache has been.
+
+    Returns:
+      - A dict with the number of entries and bytes in use, plus counts of
+          hits, misses, evictions and expirations since startup.
+    """
+    with self.lock:
+      return {
+        "entries": len(self.entries),
+        "bytes": self.size,
+        "max_bytes": self.max_bytes,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "expirations": self.expirations,
+        "data_version": data_version.generation
+      }
+
+class Memo(object):
+  """A small, thread-safe store for values computed from the database,
+  such as result counts, that stay valid until the data version changes
+  (or config.data_version["max_age"] seconds pass, whichever is first).
+  Only the most recently used max_entries values are kept.
+
+  """
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.entries = OrderedDict() # key -> (expiration time, value)
+    self.lock = threading.Lock()
+    memos.append(self)
+
+  def get(self, key):
+    """Returns the value stored for a key, or None if there isn't one."""
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      if entry[0] < time.time():
+        del self.entries[key]
+        return None
+      self.entries.move_to_end(key)
+      return entry[1]
+
+  def put(self, key, value):
+    """Stores a value, dropping the least recently used one if the memo is full."""
+    with self.lock:
+      self.entries[key] = (time.time() + config.data_version["max_age"], value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def clear(self):
+    """Drops every stored value."""
+    with self.lock:
+      self.entries.clear()
+
+memos = [] # every Memo, so they can all be cleared when the data changes
+
+class DataVersion(object):
+  """Keeps track of the generation of the data in the database, as
+  recorded in the data_version table by the spider.
+
+  """
+  def __init__(self):
+    self.generation = None
+    self.updated = None
+    self.checked = 0
+    self.lock = threading.Lock()
+
+  def check(self, connection):
+    """Looks up the current data generation, unless that was already done
+    within the last config.data_version["poll_interval"] seconds. If the
+    generation has changed since the last check, the response cache is
+    cleared.
+
+    Arguments:
+      - connection: a database Connection object.
+
+    Returns:
+      - The current generation number, or None if it has never been found.
+
+    """
+    if time.time() - self.checked < config.data_version["poll_interval"]:
+      return self.generation
+    with self.lock:
+      if time.time() - self.checked < config.data_version["poll_interval"]:
+        return self.generation # another thread just checked
+      self.checked = time.time()
+      try:
+        resp = connection.read("SELECT generation, updated FROM data_version;")
+      except Exception as e:
+        print(f"ERROR checking data version: {e}")
+        return self.generation
+      if len(resp) != 1:
+        return self.generation
+      generation, self.updated = resp[0]
+      if generation != self.generation:
+        if self.generation is not None:
+          print(f"Data version changed from {self.generation} to {generation}. Clearing caches.")
+          responses.clear()
+          for memo in memos:
+            memo.clear()
+        self.generation = generation
+      return self.generation
+
+responses = ResponseCache(config.response_cache["max_bytes"])
+data_version = DataVersion()
+counts = Memo(config.paper_count["cache_entries"])
+categories = Memo(3) # one list of categories per repository, plus "all"
+fragments = Memo(config.fragment_cache_entries) # serialized search results, by paper ID
+cache_controls = Memo(config.etag["remembered"]) # the Cache-Control header sent for each request_key()
+
+def request_key():
+  """Builds a cache key for the current request out of its path and its
+  query parameters, sorted so that parameter order doesn't matter."""
+  params = sorted(bottle.request.query.allitems())
+  return f"{bottle.request.path}?{urlencode(params)}"
+
+def note_version():
+  """Records the data generation (and max_age period) that the current
+  request is answered from. Call it before the request reads anything, so
+  if the generation changes while the response is being built, the
+  response still gets the ETag of the data it was built from."""
+  bottle.request.environ["rxivist.data_version"] = (data_version.generation, int(time.time() // config.data_version["max_age"]))
+
+def etag(encoding=None):
+  """Builds an ETag for the current request. Because every response is
+  determined by the request and the data in the database, the ETag is a
+  hash of the normalized request plus the data generation it was built
+  from (see note_version()).
+
+  Arguments:
+    - encoding: (Optionally) the compression applied to the response,
+        which gets its own ETag.
+
+  Returns:
+    - A quoted ETag string, or None if the request's path is listed in
+        config.etag["exempt"] or the data generation isn't known.
+
+  """
+  # (the period is there so a response isn't treated as current forever
+  # if the data changes without the generation being bumped)
+  generation, period = bottle.request.environ.get("rxivist.data_version",
+    (data_version.generation, int(time.time() // config.data_version["max_age"])))
+  if generation is None or bottle.request.path in config.etag["exempt"]:
+    return None
+  digest = hashlib.sha1(request_key().encode("utf-8")).hexdigest()[:20]
+  if encoding is not None:
+    return f'"{generation}.{period}-{digest}-{encoding}"'
+  return f'"{generation}.{period}-{digest}"'
+
+def etag_matches(tags):
+  """Determines whether the current request's If-None-Match header
+  indicates the client already has one of the given responses.
+
+  Arguments:
+    - tags: The ETags (as built by etag()) of the responses the server
+        could send for this request.
+
+  Returns:
+    - The ETag the client already has, or None if it has none of them.
+
+  """
+  header = bottle.request.get_header("If-None-Match")
+  tags = [t for t in tags if t is not None]
+  if header is None or len(tags) == 0:
+    return None
+  for candidate in header.split(","):
+    candidate = candidate.strip()
+    if candidate.startswith("W/"):
+      candidate = candidate[2:]
+    if candidate == "*":
+      return tags[0]
+    if candidate in tags:
+      return candidate
+  return None
+
+def cached(ttl_key, condition=None):
+  """Decorator for routes whose responses should be cached.
+
+  Only successful responses are stored: either dicts, which are
+  serialized here, or JSON the route has already serialized into bytes.
+  Cached responses are sent with the same Cache-Control header the route
+  set when it built them.
+
+  Arguments:
+    - ttl_key: The entry in config.cache indicating how long a response
+        should be kept.
+    - condition: (Optionally) a function that returns False for requests
+        that shouldn't use the cache at all.
+
+  """
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if not config.response_cache["enabled"] or (condition is not None and not condition()):
+        return func(*args, **kwargs)
+
+      key = request_key()
+      entry = responses.get(key)
+      if entry is not None:
+        body, headers = entry
+        for name, value in headers:
+          bottle.response.set_header(name, value)
+        bottle.response.content_type = "application/json"
+        return _encoded(key, body)
+
+      generation = data_version.generation
+      result = func(*args, **kwargs)
+      if bottle.response.status_code != 200 or not isinstance(result, (dict, bytes)):
+        return result
+      body = result if isinstance(result, bytes) else helpers.json_dumps(result)
+      headers = [("Cache-Control", bottle.response.get_header("Cache-Control"))]
+      headers = [h for h in headers if h[1] is not None]
+      ttl = min(config.cache[ttl_key], config.response_cache["max_ttl"])
+      # don't store a response that may have been built from
+      # data that was replaced while it was being generated
+      if generation == data_version.generation:
+        responses.put(key, body, headers, ttl)
+      bottle.response.content_type = "application/json"
+      return _encoded(key, body)
+    return wrapper
+  return decorator
+
+def _encoded(key, body):
+  """Compresses a cached response for the current request, if the client
+  accepts compressed responses, reusing the compressed copy stored in the
+  cache if there is one.
+
+  Arguments:
+    - key: The normalized request, as built by request_key()
+    - body: The uncompressed response
+
+  Returns:
+    - The body to send
+
+  """
+  if len(body) < config.compression["min_bytes"]:
+    return body
+  encoding = compression.negotiate()
+  if encoding is None:
+    bottle.response.add_header("Vary", "Accept-Encoding")
+    return body
+  compressed = responses.variant(key, encoding)
+  if compressed is None:
+    compressed = compression.compress(body, encoding)
+    responses.add_variant(key, encoding, compressed)
+  compression.set_headers(encoding)
+  return compressed
@@ -0,0 +1,100 @@
+"""Compression of API responses.
+
+Responses are compressed with the best encoding the client accepts
+(brotli, if the brotli package is installed, or gzip). Responses served
+from the in-memory cache keep their compressed copies alongside the
+originals, so each one is compressed only once per data version.
+"""
+import functools
+import gzip
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+import bottle
+
+import config
+import profiling
+
+def available():
+  """Lists the encodings the server can produce, in order of preference."""
+  return [e for e in config.compression["encodings"] if e == "gzip" or (e == "br" and brotli is not None)]
+
+def negotiate():
+  """Picks the encoding to use for the current request's response, based on
+  its Accept-Encoding header.
+
+  Returns:
+    - "br", "gzip", or None if the response shouldn't be compressed.
+        (Responses that get a query breakdown added by the profiling
+        plugin are never compressed.)
+
+  """
+  if not config.compression["enabled"] or profiling.debug_requested():
+    return None
+  header = bottle.request.get_header("Accept-Encoding")
+  if header is None:
+    return None
+  accepted = {}
+  for entry in header.split(","):
+    parts = [p.strip() for p in entry.split(";")]
+    quality = 1.0
+    for param in parts[1:]:
+      if param.startswith("q="):
+        try:
+          quality = float(param[2:])
+        except ValueError:
+          quality = 0.0
+    accepted[parts[0].lower()] = quality
+  for encoding in available():
+    if accepted.get(encoding, accepted.get("*", 0)) > 0:
+      return encoding
+  return None
+
+def compress(body, encoding):
+  """Compresses a response body.
+
+  Arguments:
+    - body: The UTF-8 encoded response
+    - encoding: "br" or "gzip"
+
+  Returns:
+    - The compressed body
+
+  """
+  if encoding == "br":
+    return brotli.compress(body, quality=config.compression["brotli_quality"])
+  return gzip.compress(body, compresslevel=config.compression["gzip_level"])
+
+def set_headers(encoding):
+  """Marks the current response as compressed with the given encoding."""
+  bottle.response.set_header("Content-Encoding", encoding)
+  bottle.response.add_header("Vary", "Accept-Encoding")
+
+def plugin(callback):
+  """Bottle plugin that compresses serialized responses that are large
+  enough to be worth it. Responses that were already compressed (such as
+  those from the response cache), streamed responses and errors are
+  passed through untouched.
+
+  """
+  @functools.wraps(callback)
+  def wrapper(*args, **kwargs):
+    body = callback(*args, **kwargs)
+    if isinstance(body, str):
+      body = body.encode("utf-8")
+    if not isinstance(body, bytes) or bottle.response.status_code != 200:
+      return body
+    if bottle.response.get_header("Content-Encoding") is not None:
+      return body
+    if len(body) < config.compression["min_bytes"]:
+      return body
+    encoding = negotiate()
+    if encoding is None:
+      bottle.response.add_header("Vary", "Accept-Encoding")
+      return body
+    set_headers(encoding)
+    return compress(body, encoding)
+  return wrapper
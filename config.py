@@ -9,7 +9,62 @@ cache = {
   "front_page": 600,
   "simple": 7200,
   "paper": 604800, # 1 week
-  "author": 604800 # 1 week
+  "author": 604800, # 1 week
+  "top": 15552000, # 180 days
+  "distributions": 7200,
+  "summary": 1200
+}
+
+# Responses from the busiest endpoints are also cached in memory
+# by the API itself, for as long as specified in the "cache" setting
+# above, but never longer than max_ttl seconds. Once the cached responses
+# take up more than max_bytes, the least recently used are dropped.
+# (Cached responses are also dropped whenever the data version changes;
+# see below.)
+response_cache = {
+  "enabled": True,
+  "max_bytes": 64 * 1024 * 1024,
+  "max_ttl": 86400
+}
+
+# Responses of at least min_bytes are compressed for clients that
+# accept it, with the first of "encodings" the client supports. ("br"
+# requires the brotli package, which isn't in requirements.txt; without
+# it, gzip is used.) Cached responses keep their compressed copies.
+compression = {
+  "enabled": True,
+  "min_bytes": 1024,
+  "encodings": ["br", "gzip"],
+  "gzip_level": 6,
+  "brotli_quality": 5
+}
+
+# Calling bump_data_version() (see db/migrations/001_data_version.sql)
+# increases the generation number in the data_version table, which
+# should be done whenever the spider finishes updating rankings; nothing
+# in this repository calls it yet. poll_interval is how many seconds can
+# pass before the API checks the table again. Because the data can change
+# without the number being bumped, max_age caps how many seconds anything
+# tied to the generation is trusted: remembered result counts, category
+# lists and serialized search results are looked up again, and ETags
+# change, at least that often.
+data_version = {
+  "poll_interval": 30,
+  "max_age": 3600
+}
+
+# Every successful response gets an ETag built from the data version and
+# the request parameters. Requests with a matching If-None-Match header
+# get an empty 304 response without touching the database. Paths listed in
+# "exempt" report live server state and never get an ETag. A 304 has to
+# carry the Cache-Control header the full response would have had, so the
+# header sent for each request is remembered (for up to "remembered"
+# distinct requests at a time); a request whose header isn't known gets
+# the full response, even if its ETag matches.
+etag = {
+  "enabled": True,
+  "exempt": ["/v1/data/server"],
+  "remembered": 10000
 }
 
 # For the "summary statistics" endpoint, the download metrics
@@ -19,6 +74,14 @@ cache = {
 # a month's download numbers should be included.
 summary_download_age = 14
 
+# Whether the "summary statistics" endpoint should read monthly totals
+# from the monthly_stats table (see db/migrations/005_monthly_stats.sql),
+# which is kept up to date by triggers as the spider records papers and
+# downloads. If False, the totals are added up from the articles and
+# article_traffic tables on every request. Only turn this on once the
+# migration has been run, since the endpoint fails without the table.
+monthly_stats_table = False
+
 # Information about how to connect to a postgres database will
 # all the Rxivist data
 db = {
@@ -31,9 +94,57 @@ db = {
     "timeout": 3,
     "max_attempts": 10,
     "attempt_pause": 3, # how long to wait between connection attempts
+    "query_attempts": 3, # how many times to reconnect and resend a query that failed mid-flight
   },
+  # Each request checks out its own connection from a pool
+  # shared by all the threads in a worker process
+  "pool": {
+    "min_size": 2, # connections opened as soon as the pool is first used
+    "max_size": 10, # requests beyond this many wait for a free connection
+    "checkout_timeout": 10, # how long (in seconds) a request waits for a connection before failing
+    "health_check_after": 30, # connections idle for longer than this are tested before reuse
+  },
+  # Whether paper searches are sent as prepared statements, which
+  # Postgres plans once per connection rather than once per request
+  "prepared_statements": True,
+  # Whether lookups that don't depend on each other (a paper's details
+  # and its authors, for example) are sent at the same time on separate
+  # connections from the pool, rather than one after another
+  "concurrent_queries": True,
+}
+
+# Every request keeps a tally of the database queries it sends: how many,
+# how long they took, how many rows they returned and which was slowest.
+# - server_timing: Whether responses report the totals in a Server-Timing
+#     header (which browsers' developer tools display).
+# - debug_parameter: Requests with this query parameter set to "queries"
+#     get the full breakdown added to their JSON response, under a "debug"
+#     key. The breakdown includes the SQL of every query, so it's off
+#     (None) unless a name is set here. Use something that can't be
+#     guessed on a public server, since anyone who knows it can see the
+#     queries: "debug_7f3c9a" would mean "?debug_7f3c9a=queries". Setting
+#     it to "server" instead ("?debug_7f3c9a=server") is the only way to
+#     reach the server health endpoint, /v1/data/server, which reports
+#     the connection pool, cache and ranking builds.
+# - slow_request_ms: Requests that take longer than this are logged,
+#     along with every query they sent.
+profiling = {
+  "enabled": True,
+  "server_timing": True,
+  "debug_parameter": None,
+  "slow_request_ms": 1000,
 }
 
+# Which library serializes JSON responses: "orjson" is considerably
+# faster, but isn't in requirements.txt; if it's named here and isn't
+# installed, the standard library's "json" module is used instead.
+json_encoder = "orjson"
+
+# Each paper's search result (everything except the metric it was ranked
+# by) is serialized once and reused by every search that includes it,
+# until the data version changes. This is how many papers to remember.
+fragment_cache_entries = 10000
+
 # Hostname (and protocol) where users will find your site.
 # This is needed to build redirect URLs that don't
 # break when the web server is behind a reverse proxy.
@@ -45,12 +156,56 @@ host = "https://api.url_goes_in_here.org"
 # code change.
 use_prod_webserver = True
 
+# Settings passed to gunicorn when use_prod_webserver is True. With the
+# default "sync" worker class, each worker process handles one request
+# at a time. The "gthread" worker class lets each process serve
+# "threads" requests at once, which share that process's connection
+# pool (so db["pool"]["max_size"] should be at least "threads").
+gunicorn = {
+  "workers": 1,
+  "worker_class": "sync",
+  "threads": 1
+}
+
 # how many search results are returned at a time
 default_page_size = 20
 
 # the most results an API user can request at one time
 max_page_size = 250
 
+# How paper searches figure out the total number of results:
+# - "window": counted by the same query that fetches the page of
+#     results, using a window function. (Falls back to a cached count
+#     when it can't be determined from the page, such as when using cursors.)
+# - "cached": counted by a separate query, which is remembered for each
+#     combination of filters until the data version changes.
+# - "separate": counted by a separate query every time.
+# If estimate_text_search is True, searches with a text query instead
+# report the number of results estimated by the Postgres query planner.
+# cache_entries is how many counts to remember.
+paper_count = {
+  "strategy": "window",
+  "estimate_text_search": False,
+  "cache_entries": 5000
+}
+
+# The bulk export endpoint (/v1/export/papers) sends every paper in a
+# single gzip-compressed file. fetch_size is how many rows are read from
+# the database at a time, and chunk_size is roughly how many bytes of
+# output are compressed and sent at a time. Each export holds a database
+# connection until the client has downloaded the whole file, so no more
+# than max_concurrent run at once (per worker process; keep it well below
+# db["pool"]["max_size"]). Requests beyond that get a 503 response
+# asking the client to retry after retry_after seconds.
+export = {
+  "enabled": True,
+  "fetch_size": 2000,
+  "chunk_size": 65536,
+  "compression_level": 6,
+  "max_concurrent": 2,
+  "retry_after": 60
+}
+
 # Amount of time that can pass since an article has been updated before
 # it is included in the tally of "outdated" articles
 outdated_limit = "4 weeks"
@@ -58,6 +213,22 @@ outdated_limit = "4 weeks"
 # When displaying a leaderboard of author rankings, how many names should appear
 author_ranks_limit = 200
 
+# Whether papers ranked by tweets should be read from the precomputed
+# twitter_*_ranks tables (see db/migrations/003_twitter_ranks.sql). If
+# False, tweets are totalled from the raw crossref_daily table on every
+# request. Only turn this on once refresh_twitter_ranks() is being called
+# every time new Crossref data is fetched (the spider's
+# perform_ranks["twitter"] setting); otherwise the rankings stay as they
+# were when the migration ran.
+twitter_rank_tables = False
+
+# Whether text searches use the indexed articles.search_vector column
+# (see db/migrations/004_search_vector.sql). If False, each paper's title,
+# abstract and author vectors are combined on every search, which can't
+# use an index. Only turn this on once the migration has been run, since
+# every text search fails without the column.
+search_vector_column = False
+
 # When a user requests daily twitter metrics, this is the
 # minimum number of papers we need results for before it's
 # automatically rolled over to "weekly"
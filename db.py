@@ -1,36 +1,181 @@
 """Functions governing the application's interactions with the databas.
 
-There is essentially no business logic in here; it establishes a connection
-to the application's database and that's all.
+There is essentially no business logic in here; it maintains a pool of
+connections to the application's database and that's all.
 """
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import re
+import threading
 import time
 
 import psycopg2
+import psycopg2.extensions
 
 import config
 
+class PreparingConnection(psycopg2.extensions.connection):
+  """A psycopg2 connection that remembers which statements have been
+  prepared on its database session, since prepared statements only last as
+  long as the session that created them."""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.prepared = set()
+
+def _prepared_name(query):
+  """Builds the name of the prepared statement for a query. Every
+  query with the same SQL shares a name, so the finite set of queries
+  built by the API each get planned once per session."""
+  return "rx_" + hashlib.sha1(query.encode("utf-8")).hexdigest()[:20]
+
+def _numbered_params(query):
+  """Converts a query written with psycopg2-style "%s" placeholders
+  into the "$1, $2, ..." form used by PREPARE.
+
+  Returns:
+    - The converted query
+    - How many parameters it takes
+
+  """
+  count = 0
+  def replace(match):
+    nonlocal count
+    if match.group(0) == "%%":
+      return "%"
+    count += 1
+    return f"${count}"
+  return re.sub(r"%[s%]", replace, query), count
+
+@functools.lru_cache(maxsize=1024)
+def query_shape(query):
+  """Normalizes a query so every query built from the same template
+  looks the same: literal strings and numbers (and "%s" placeholders)
+  are replaced with "?", and whitespace is collapsed."""
+  shape = re.sub(r"'(?:[^']|'')*'", "?", query)
+  shape = re.sub(r"(?<![\w$])\d+(?:\.\d+)?\b", "?", shape)
+  shape = shape.replace("%s", "?")
+  return " ".join(shape.split())
+
+class QueryProfile(object):
+  """Tally of the queries sent on behalf of a single HTTP request,
+  including those sent from other threads by Connection.concurrently()."""
+
+  def __init__(self):
+    self.started = time.time()
+    self.queries = 0
+    self.db_time = 0.0
+    self.rows = 0
+    self.shapes = {} # query shape: [count, total time, slowest time, rows]
+    self.lock = threading.Lock()
+
+  def record(self, query, elapsed, rows):
+    """Adds a finished query to the tally.
+
+    Arguments:
+      - query: The SQL that was sent.
+      - elapsed: How long (in seconds) it took to run and fetch.
+      - rows: How many rows it returned.
+    """
+
+    shape = query_shape(query)
+    with self.lock:
+      self.queries += 1
+      self.db_time += elapsed
+      self.rows += rows
+      entry = self.shapes.get(shape)
+      if entry is None:
+        self.shapes[shape] = [1, elapsed, elapsed, rows]
+      else:
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+        entry[3] += rows
+
+  def breakdown(self):
+    """Lists the distinct query shapes sent during the request, the most
+    time-consuming first.
+
+    Returns:
+      - A list of dicts, one per query shape.
+    """
+
+    with self.lock:
+      entries = sorted(self.shapes.items(), key=lambda x: x[1][1], reverse=True)
+    return [{
+      "query": shape,
+      "count": count,
+      "total_ms": round(total * 1000, 2),
+      "slowest_ms": round(slowest * 1000, 2),
+      "rows": rows,
+    } for shape, (count, total, slowest, rows) in entries]
+
+  def summary(self):
+    """Summarizes the request's database use.
+
+    Returns:
+      - A dict with the number of queries, time spent on them, rows
+          returned, the slowest single query and every query shape.
+    """
+
+    shapes = self.breakdown()
+    slowest = max(shapes, key=lambda x: x["slowest_ms"]) if len(shapes) > 0 else None
+    return {
+      "request_ms": round((time.time() - self.started) * 1000, 2),
+      "queries": self.queries,
+      "db_ms": round(self.db_time * 1000, 2),
+      "rows": self.rows,
+      "slowest": None if slowest is None else {
+        "query": slowest["query"],
+        "ms": slowest["slowest_ms"],
+      },
+      "shapes": shapes,
+    }
+
 class Connection(object):
-  """Data type holding the data required to maintain a database
-  connection and perform queries.
+  """Data type holding the data required to maintain a pool of database
+  connections and perform queries.
+
+  Connections are checked out of the pool for the duration of an HTTP
+  request (see begin_request() and end_request()), so concurrent requests
+  on different threads each get their own session rather than taking
+  turns on a single socket. Queries sent outside of a request check out
+  a connection just long enough to run.
 
   """
   def __init__(self, host, dbname, user, password):
-    """Stores db connection info in memory and initiates a
-    connection to the specified db."""
+    """Stores db connection info in memory and confirms the specified
+    db can be reached. The pool itself is filled the first time a
+    connection is needed, which keeps connections from being shared
+    between processes when a web server forks its workers."""
 
-    self.db = None
     self.host = host
     self.dbname = dbname
     self.user = user
     self.password = password
 
+    self.idle = [] # (connection, time it was returned to the pool)
+    self.in_use = 0
+    self.slots = threading.BoundedSemaphore(config.db["pool"]["max_size"])
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.filled = False
+    self.executor = None # for concurrently(), started when first needed
+
+    self.started = time.time()
+    self.checkouts = 0
+    self.wait_total = 0.0
+    self.wait_max = 0.0
+    self.failed_health_checks = 0
+    self.reconnects = 0
+
     try:
-      self._attempt_connect()
+      self._attempt_connect().close()
     except RuntimeError as e:
       print(f"FATAL: {e}")
       exit(1)
     print("Connected!")
-    self.cursor = self.db.cursor()
 
   def _attempt_connect(self, attempts=0):
     """Initiates a connection to the database and tracks retry attempts.
@@ -38,68 +183,388 @@ class Connection(object):
     Arguments:
       - attempts: How many failed attempts have already happened.
 
-    Side effects:
-      - self.db: Set on a successful connection attempt.
+    Returns:
+      - A new psycopg2 connection, in autocommit mode.
     """
 
     attempts += 1
     print(f'Connecting. Attempt {attempts} of {config.db["connection"]["max_attempts"]}.')
     try:
-      self.db = psycopg2.connect(
+      db = psycopg2.connect(
         host=self.host,
         dbname=self.dbname,
         user=self.user,
         password=self.password,
         connect_timeout=config.db["connection"]["timeout"],
-        options=f'-c search_path={config.db["schema"]}'
+        options=f'-c search_path={config.db["schema"]}',
+        connection_factory=PreparingConnection
       )
-      self.db.set_session(autocommit=True)
+      db.set_session(autocommit=True)
+      return db
     except:
       if attempts >= config.db["connection"]["max_attempts"]:
         print("Giving up.")
         raise RuntimeError("Failed to connect to database.")
       print(f'Connection to DB failed. Retrying in {config.db["connection"]["attempt_pause"] * attempts} seconds.')
       time.sleep(config.db["connection"]["attempt_pause"] * attempts)
-      self._attempt_connect(attempts)
+      return self._attempt_connect(attempts)
+
+  def _fill(self):
+    """Opens the minimum number of connections the pool should keep
+    around. Only happens once, the first time a connection is needed."""
+
+    with self.lock:
+      if self.filled:
+        return
+      self.filled = True
+      for _ in range(config.db["pool"]["min_size"]):
+        self.idle.append((self._attempt_connect(), time.time()))
+
+  def _is_healthy(self, db, returned):
+    """Determines whether an idle connection can still be used.
+
+    Arguments:
+      - db: The psycopg2 connection being checked out.
+      - returned: When the connection was last returned to the pool.
+
+    Returns:
+      - False if the connection has been closed, or if it has been sitting
+          idle long enough to warrant a test query and that query failed.
+    """
+
+    if db.closed:
+      return False
+    if time.time() - returned < config.db["pool"]["health_check_after"]:
+      return True
+    try:
+      with db.cursor() as cursor:
+        cursor.execute("SELECT 1")
+      return True
+    except psycopg2.Error:
+      return False
+
+  def _checkout(self, wait=True):
+    """Takes a healthy connection out of the pool, opening a new one if
+    there are no idle connections available. If the pool is already at
+    its maximum size, this waits for another thread to release one.
+
+    Arguments:
+      - wait: If False, give up immediately rather than waiting when the
+          pool is at its maximum size.
+
+    Returns:
+      - A psycopg2 connection reserved for the calling thread, or None if
+          "wait" is False and no connection was available.
+    """
+
+    if not self.filled:
+      self._fill()
+    start = time.time()
+    if not wait:
+      if not self.slots.acquire(blocking=False):
+        return None
+    elif not self.slots.acquire(timeout=config.db["pool"]["checkout_timeout"]):
+      raise RuntimeError("Timed out waiting for a database connection.")
+    waited = time.time() - start
+    try:
+      db = None
+      while db is None:
+        with self.lock:
+          if len(self.idle) == 0:
+            break
+          db, returned = self.idle.pop()
+        if not self._is_healthy(db, returned):
+          with self.lock:
+            self.failed_health_checks += 1
+          self._discard(db)
+          db = None
+      if db is None:
+        db = self._attempt_connect()
+    except:
+      self.slots.release()
+      raise
+
+    with self.lock:
+      self.in_use += 1
+      self.checkouts += 1
+      self.wait_total += waited
+      self.wait_max = max(self.wait_max, waited)
+    return db
+
+  def _release(self, db):
+    """Returns a checked-out connection to the pool.
+
+    Arguments:
+      - db: The psycopg2 connection being returned.
+    """
+
+    if not db.closed and db.status != psycopg2.extensions.STATUS_READY:
+      try:
+        db.rollback()
+      except psycopg2.Error:
+        self._discard(db)
+    with self.lock:
+      self.in_use -= 1
+      if not db.closed:
+        self.idle.append((db, time.time()))
+    self.slots.release()
+
+  def _discard(self, db):
+    """Closes a connection that won't be returned to the pool."""
+
+    try:
+      db.close()
+    except psycopg2.Error:
+      pass
+
+  def begin_request(self):
+    """Marks the start of an HTTP request on the current thread. The
+    first query sent after this checks out a connection that is held
+    until end_request() is called."""
+
+    self.local.scoped = True
+    self.local.db = None
+    self.local.profile = QueryProfile() if config.profiling["enabled"] else None
+
+  def end_request(self):
+    """Returns the current thread's connection (if it used one) to the
+    pool at the end of an HTTP request.
+
+    Returns:
+      - The QueryProfile of the queries sent during the request, or None
+          if config.profiling["enabled"] is False.
+    """
+
+    db = getattr(self.local, "db", None)
+    profile = getattr(self.local, "profile", None)
+    self.local.scoped = False
+    self.local.db = None
+    self.local.profile = None
+    if db is not None:
+      self._release(db)
+    return profile
 
-  def read(self, query, params=None):
+  def profile(self):
+    """Returns the QueryProfile of the current thread's request, or None
+    if there isn't one."""
+
+    return getattr(self.local, "profile", None)
+
+  def concurrently(self, *calls):
+    """Runs several independent lookups at the same time, each on its
+    own connection from the pool, and waits for all of them to finish.
+    The first one runs on the calling thread (and its connection). Any
+    others that can't get a connection without waiting also run on the
+    calling thread once the first is done, so a busy pool slows
+    requests down rather than deadlocking them.
+
+    Arguments:
+      - calls: Functions that take no arguments and send their queries
+          through this Connection.
+
+    Returns:
+      - A list of the values returned by each function, in order.
+    """
+
+    if not config.db["concurrent_queries"] or len(calls) < 2:
+      return [call() for call in calls]
+    if self.executor is None:
+      with self.lock:
+        if self.executor is None:
+          self.executor = ThreadPoolExecutor(max_workers=config.db["pool"]["max_size"])
+    profile = self.profile()
+    futures = [self.executor.submit(self._run_spare, call, profile) for call in calls[1:]]
+    results = [calls[0]()]
+    for call, future in zip(calls[1:], futures):
+      ran, value = future.result()
+      results.append(value if ran else call())
+    return results
+
+  def _run_spare(self, call, profile):
+    """Runs a function from concurrently() on a worker thread, using
+    a connection that's checked out only if one is free right away.
+
+    Arguments:
+      - call: The function to run.
+      - profile: The QueryProfile of the request that called
+          concurrently(), which the function's queries are added to.
+
+    Returns:
+      - Whether the function was run
+      - What it returned
+    """
+
+    db = self._checkout(wait=False)
+    if db is None:
+      return False, None
+    self.local.scoped = True
+    self.local.db = db
+    self.local.profile = profile
+    try:
+      return True, call()
+    finally:
+      self.end_request()
+
+  def _execute_prepared(self, db, cursor, query, params):
+    """Sends a query as a server-side prepared statement, preparing it
+    first if this is the first time it's been sent on this connection.
+
+    Arguments:
+      - db: The PreparingConnection the cursor belongs to.
+      - cursor: The cursor to execute the statement with.
+      - query: The SQL query, with "%s" placeholders.
+      - params: The parameters to bind to the placeholders.
+
+    """
+    name = _prepared_name(query)
+    if name not in db.prepared:
+      numbered, _ = _numbered_params(query)
+      cursor.execute(f"PREPARE {name} AS {numbered}")
+      db.prepared.add(name)
+    if params is None or len(params) == 0:
+      cursor.execute(f"EXECUTE {name}")
+    else:
+      placeholders = ", ".join(["%s"] * len(params))
+      cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+  def read(self, query, params=None, prepare=False):
     """Helper function that converts results returned stored in a
     Psycopg cursor into a less temperamental list format. Note that
-    there IS recursive retry logic here; when the connection to the
-    database is dropped, the query will fail, prompting this method
-    to re-connect and try the query again. This will continue trying
-    to reconnect indefinitely. This is probably not ideal.
+    there IS retry logic here; when the connection to the database
+    is dropped, the query will fail, prompting this method to re-connect
+    and try the query again, up to the number of times specified in
+    config.db["connection"]["query_attempts"].
 
     Arguments:
       - query: The SQL query to be executed.
       - params: Any parameters to be substituted into the query. It's
           important to let Psycopg handle this rather than using Python
           string interpolation because it helps mitigate SQL injection.
+      - prepare: Whether to send the query as a prepared statement, so
+          Postgres only plans it the first time it's sent on each
+          connection. Only worthwhile for queries whose SQL is reused
+          with different parameters. (Ignored if
+          config.db["prepared_statements"] is False.)
     Returns:
       - A list of tuples, one for each row of results.
 
     """
 
-    results = []
+    scoped = getattr(self.local, "scoped", False)
+    db = getattr(self.local, "db", None)
+    if db is None:
+      db = self._checkout()
+      if scoped:
+        self.local.db = db
+
+    started = time.time()
     try:
-      with self.db.cursor() as cursor:
-        if params is not None:
-          cursor.execute(query, params)
-        else:
-          cursor.execute(query)
+      attempts = 0
+      while True:
+        attempts += 1
+        try:
+          with db.cursor() as cursor:
+            if prepare and config.db["prepared_statements"]:
+              self._execute_prepared(db, cursor, query, params)
+            elif params is not None:
+              cursor.execute(query, params)
+            else:
+              cursor.execute(query)
+            # (for results too big to hold in memory at once, use stream())
+            results = cursor.fetchall()
+          profile = getattr(self.local, "profile", None)
+          if profile is not None:
+            profile.record(query, time.time() - started, len(results))
+          return results
+        except psycopg2.OperationalError as e:
+          print(f"ERROR with db query execution: {e}")
+          if attempts >= config.db["connection"]["query_attempts"]:
+            print("Giving up on query.")
+            raise
+          print("Reconnecting.")
+          self._discard(db)
+          with self.lock:
+            self.reconnects += 1
+          db = self._attempt_connect()
+          if scoped:
+            self.local.db = db
+          print("Sending query again.")
+    finally:
+      if not scoped:
+        self._release(db)
+
+  def stream(self, query, params=None, fetch_size=2000, withhold=False):
+    """Runs a query through a server-side (named) cursor and yields the
+    results one row at a time, fetching them from the database in
+    batches, so a large result set never has to be held in memory all
+    at once.
+
+    The stream checks out its own connection, and keeps it until the
+    last row has been read or the generator is closed, since a response
+    built from it may still be sent long after the request's own
+    connection has been returned to the pool. Unlike read(), there is no
+    retry logic: a dropped connection ends the stream with an error.
+
+    Arguments:
+      - query: The SQL query to be executed.
+      - params: Any parameters to be substituted into the query.
+      - fetch_size: How many rows to fetch from the database at a time.
+          (The bulk export reads its own from config.export.)
+      - withhold: Whether to declare the cursor WITH HOLD. Normally the
+          cursor's transaction (and its snapshot, and its locks) stays open
+          until the last row is read, which for a slow client can be a
+          very long time. A held cursor's transaction commits right away,
+          at the cost of Postgres computing the full result up front and
+          storing it until the stream ends.
+    Returns:
+      - A generator of tuples, one for each row of results.
+
+    """
+
+    db = self._checkout()
+    try:
+      # named cursors only live inside a transaction, unless they're held
+      db.autocommit = withhold
+      with db.cursor(name=f"rx_stream_{id(db)}", withhold=withhold) as cursor:
+        cursor.itersize = fetch_size
+        cursor.execute(query, params)
         for result in cursor:
-          results.append(result)
-      return results
-    except psycopg2.OperationalError as e:
-      print(f"ERROR with db query execution: {e}")
-      print("Reconnecting.")
-      self._attempt_connect()
-      print("Sending query again.")
-      return self.read(query, params)
+          yield result
+    finally:
+      try:
+        db.rollback()
+        db.autocommit = True
+      except psycopg2.Error:
+        self._discard(db)
+      self._release(db)
+
+  def stats(self):
+    """Reports how busy the connection pool has been.
+
+    Returns:
+      - A dict of pool metrics: current size and usage, total checkouts
+          and the checkout rate since startup, and how long threads have
+          spent waiting for a free connection.
+    """
+
+    with self.lock:
+      uptime = time.time() - self.started
+      return {
+        "min_size": config.db["pool"]["min_size"],
+        "max_size": config.db["pool"]["max_size"],
+        "idle": len(self.idle),
+        "in_use": self.in_use,
+        "checkouts": self.checkouts,
+        "checkouts_per_sec": round(self.checkouts / uptime, 3) if uptime > 0 else 0,
+        "wait_ms_avg": round(1000 * self.wait_total / self.checkouts, 3) if self.checkouts > 0 else 0,
+        "wait_ms_max": round(1000 * self.wait_max, 3),
+        "failed_health_checks": self.failed_health_checks,
+        "reconnects": self.reconnects
+      }
 
   def __del__(self):
-    """Closes the database connection when the Connection object
+    """Closes the pooled database connections when the Connection object
     is destroyed."""
 
-    if self.db is not None:
-      self.db.close()
\ No newline at end of file
+    for db, _ in self.idle:
+      self._discard(db)
@@ -0,0 +1,20 @@
+-- A single-row table holding the "generation" of the data served by the
+-- API. Calling prod.bump_data_version() increases it, which the spider
+-- should do at the end of every run that rewrites rankings or Crossref
+-- stats. The API drops its cached responses whenever it sees the number
+-- change. (Cached values also expire after config.data_version["max_age"]
+-- seconds, in case the data changes without the number being bumped.)
+
+CREATE TABLE IF NOT EXISTS prod.data_version (
+  id boolean PRIMARY KEY DEFAULT true CHECK (id),
+  generation bigint NOT NULL DEFAULT 0,
+  updated timestamp with time zone NOT NULL DEFAULT now()
+);
+
+INSERT INTO prod.data_version (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION prod.bump_data_version() RETURNS bigint AS $$
+  UPDATE prod.data_version
+  SET generation = generation + 1, updated = now()
+  RETURNING generation;
+$$ LANGUAGE sql;
@@ -0,0 +1,7 @@
+-- Indexes that let the API page through download rankings by seeking
+-- directly to the (rank, article) pair that ended the previous page,
+-- rather than reading and discarding every earlier row with OFFSET.
+
+CREATE INDEX IF NOT EXISTS alltime_ranks_rank_article ON prod.alltime_ranks (rank, article);
+CREATE INDEX IF NOT EXISTS ytd_ranks_rank_article ON prod.ytd_ranks (rank, article);
+CREATE INDEX IF NOT EXISTS month_ranks_rank_article ON prod.month_ranks (rank, article);
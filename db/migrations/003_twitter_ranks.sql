@@ -0,0 +1,143 @@
+-- Precomputed Twitter rankings, one table per timeframe, so the API can
+-- rank papers by tweets with an indexed lookup instead of summing
+-- crossref_daily for every request. They mirror the download rankings
+-- in alltime_ranks, ytd_ranks and month_ranks.
+--
+-- The all-time totals are kept up to date as Crossref rows are written,
+-- by statement-level triggers on crossref_daily. The rankings themselves
+-- (including the rolling timeframes, which only need the last year of
+-- crossref_daily) are recalculated by refresh_twitter_ranks(). This
+-- migration builds them once; after that, they're only as current as the
+-- last call to refresh_twitter_ranks(), which should happen every time
+-- new Crossref data is fetched. (The API only reads them if
+-- config.twitter_rank_tables is True.)
+
+CREATE TABLE IF NOT EXISTS prod.twitter_totals (
+  doi text PRIMARY KEY,
+  tweets bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS prod.twitter_alltime_ranks (article integer PRIMARY KEY, rank integer NOT NULL, tweets bigint NOT NULL);
+CREATE TABLE IF NOT EXISTS prod.twitter_day_ranks (article integer PRIMARY KEY, rank integer NOT NULL, tweets bigint NOT NULL);
+CREATE TABLE IF NOT EXISTS prod.twitter_week_ranks (article integer PRIMARY KEY, rank integer NOT NULL, tweets bigint NOT NULL);
+CREATE TABLE IF NOT EXISTS prod.twitter_month_ranks (article integer PRIMARY KEY, rank integer NOT NULL, tweets bigint NOT NULL);
+CREATE TABLE IF NOT EXISTS prod.twitter_year_ranks (article integer PRIMARY KEY, rank integer NOT NULL, tweets bigint NOT NULL);
+
+CREATE INDEX IF NOT EXISTS twitter_alltime_ranks_rank_article ON prod.twitter_alltime_ranks (rank, article);
+CREATE INDEX IF NOT EXISTS twitter_day_ranks_rank_article ON prod.twitter_day_ranks (rank, article);
+CREATE INDEX IF NOT EXISTS twitter_week_ranks_rank_article ON prod.twitter_week_ranks (rank, article);
+CREATE INDEX IF NOT EXISTS twitter_month_ranks_rank_article ON prod.twitter_month_ranks (rank, article);
+CREATE INDEX IF NOT EXISTS twitter_year_ranks_rank_article ON prod.twitter_year_ranks (rank, article);
+
+CREATE INDEX IF NOT EXISTS crossref_daily_source_date ON prod.crossref_daily (source_date);
+
+-- Seed the running totals from everything recorded so far
+INSERT INTO prod.twitter_totals (doi, tweets)
+  SELECT doi, SUM(count) FROM prod.crossref_daily GROUP BY doi
+ON CONFLICT (doi) DO UPDATE SET tweets = EXCLUDED.tweets;
+
+CREATE OR REPLACE FUNCTION prod.add_twitter_totals() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO prod.twitter_totals (doi, tweets)
+    SELECT doi, SUM(count) FROM new_rows GROUP BY doi
+  ON CONFLICT (doi) DO UPDATE SET tweets = prod.twitter_totals.tweets + EXCLUDED.tweets;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION prod.remove_twitter_totals() RETURNS trigger AS $$
+BEGIN
+  UPDATE prod.twitter_totals t
+  SET tweets = t.tweets - old.tweets
+  FROM (SELECT doi, SUM(count) AS tweets FROM old_rows GROUP BY doi) AS old
+  WHERE t.doi = old.doi;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Applies the difference an UPDATE made to each DOI's total. (Updates
+-- that don't change "count" or "doi" cancel out and write nothing.)
+CREATE OR REPLACE FUNCTION prod.update_twitter_totals() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO prod.twitter_totals (doi, tweets)
+    SELECT doi, SUM(delta)
+    FROM (
+      SELECT doi, count AS delta FROM new_rows
+      UNION ALL
+      SELECT doi, -count FROM old_rows
+    ) AS changes
+    GROUP BY doi
+    HAVING SUM(delta) != 0
+  ON CONFLICT (doi) DO UPDATE SET tweets = prod.twitter_totals.tweets + EXCLUDED.tweets;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS crossref_daily_insert_totals ON prod.crossref_daily;
+CREATE TRIGGER crossref_daily_insert_totals
+  AFTER INSERT ON prod.crossref_daily
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.add_twitter_totals();
+
+-- (Triggers with transition tables can't be limited to UPDATE OF count,
+-- so this fires for every UPDATE and ignores the ones that cancel out.)
+DROP TRIGGER IF EXISTS crossref_daily_update_totals ON prod.crossref_daily;
+CREATE TRIGGER crossref_daily_update_totals
+  AFTER UPDATE ON prod.crossref_daily
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.update_twitter_totals();
+
+DROP TRIGGER IF EXISTS crossref_daily_delete_totals ON prod.crossref_daily;
+CREATE TRIGGER crossref_daily_delete_totals
+  AFTER DELETE ON prod.crossref_daily
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.remove_twitter_totals();
+
+-- Rebuilds the ranking for a single timeframe. Runs in the caller's
+-- transaction, so the API keeps reading the previous ranking until
+-- the new one is committed.
+CREATE OR REPLACE FUNCTION prod.refresh_twitter_ranks(timeframe text) RETURNS integer AS $$
+DECLARE
+  days integer;
+  total integer;
+BEGIN
+  EXECUTE format('DELETE FROM prod.%I', 'twitter_' || timeframe || '_ranks');
+  IF timeframe = 'alltime' THEN
+    INSERT INTO prod.twitter_alltime_ranks (article, rank, tweets)
+      SELECT a.id, RANK() OVER (ORDER BY t.tweets DESC), t.tweets
+      FROM prod.twitter_totals t
+      INNER JOIN prod.articles a ON a.doi=t.doi
+      WHERE t.tweets > 0;
+  ELSE
+    days := CASE timeframe
+      WHEN 'day' THEN 2
+      WHEN 'week' THEN 7
+      WHEN 'month' THEN 30
+      WHEN 'year' THEN 365
+    END;
+    IF days IS NULL THEN
+      RAISE EXCEPTION 'Unrecognized Twitter timeframe: %', timeframe;
+    END IF;
+    EXECUTE format($q$
+      INSERT INTO prod.%I (article, rank, tweets)
+        SELECT a.id, RANK() OVER (ORDER BY SUM(c.count) DESC), SUM(c.count)
+        FROM prod.crossref_daily c
+        INNER JOIN prod.articles a ON a.doi=c.doi
+        WHERE c.source_date > now() - make_interval(days => %s)
+        GROUP BY a.id
+    $q$, 'twitter_' || timeframe || '_ranks', days);
+  END IF;
+  GET DIAGNOSTICS total = ROW_COUNT;
+  EXECUTE format('ANALYZE prod.%I', 'twitter_' || timeframe || '_ranks');
+  RETURN total;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rebuilds the rankings for every timeframe
+CREATE OR REPLACE FUNCTION prod.refresh_twitter_ranks() RETURNS void AS $$
+  SELECT prod.refresh_twitter_ranks(timeframe)
+  FROM unnest(ARRAY['alltime', 'day', 'week', 'month', 'year']) AS timeframe;
+$$ LANGUAGE sql;
+
+-- Build the rankings from everything recorded so far
+SELECT prod.refresh_twitter_ranks();
@@ -0,0 +1,16 @@
+-- A single weighted search vector for each article, so text searches can
+-- be answered from a GIN index instead of combining the title, abstract
+-- and author vectors for every row. Because it's a generated column,
+-- Postgres recalculates it whenever the spider writes any of the vectors
+-- it's built from. (Generated columns require PostgreSQL 12 or later.)
+-- The API only searches this column once config.search_vector_column is
+-- True.
+
+ALTER TABLE prod.articles ADD COLUMN IF NOT EXISTS search_vector tsvector
+  GENERATED ALWAYS AS (
+    setweight(coalesce(title_vector, ''::tsvector), 'A') ||
+    setweight(coalesce(abstract_vector, ''::tsvector), 'C') ||
+    setweight(coalesce(author_vector, ''::tsvector), 'D')
+  ) STORED;
+
+CREATE INDEX IF NOT EXISTS articles_search_vector ON prod.articles USING GIN (search_vector);
@@ -0,0 +1,155 @@
+-- Monthly submission and download totals for each repository, so the
+-- summary endpoint can read a few hundred precomputed rows instead of
+-- grouping every article and every article_traffic row on each request.
+--
+-- The totals are kept up to date by statement-level triggers on articles
+-- (submissions, by the month a paper was posted) and article_traffic
+-- (downloads, by the month they were recorded). Each statement applies
+-- only the difference it makes, so the cost of keeping the table current
+-- is proportional to the rows the spider writes, not to the size of
+-- article_traffic. The API only reads this table once
+-- config.monthly_stats_table is True.
+
+CREATE TABLE IF NOT EXISTS prod.monthly_stats (
+  repo text NOT NULL,
+  year integer NOT NULL,
+  month integer NOT NULL,
+  submissions bigint NOT NULL DEFAULT 0,
+  downloads bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (repo, year, month)
+);
+
+-- Seed the totals from everything recorded so far
+TRUNCATE prod.monthly_stats;
+
+INSERT INTO prod.monthly_stats (repo, year, month, submissions)
+  SELECT repo, EXTRACT(YEAR FROM posted)::int, EXTRACT(MONTH FROM posted)::int, COUNT(id)
+  FROM prod.articles
+  WHERE posted IS NOT NULL AND repo IS NOT NULL
+  GROUP BY 1, 2, 3;
+
+INSERT INTO prod.monthly_stats (repo, year, month, downloads)
+  SELECT a.repo, t.year, t.month, SUM(t.pdf)
+  FROM prod.article_traffic t
+  INNER JOIN prod.articles a ON t.article=a.id
+  WHERE a.repo IS NOT NULL
+  GROUP BY 1, 2, 3
+ON CONFLICT (repo, year, month) DO UPDATE SET downloads = EXCLUDED.downloads;
+
+-- Adds submissions for new or changed articles, and takes them away for
+-- deleted or changed ones. (Updates that don't touch "posted" or "repo"
+-- cancel out and write nothing.)
+CREATE OR REPLACE FUNCTION prod.update_monthly_submissions() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO prod.monthly_stats (repo, year, month, submissions)
+      SELECT repo, EXTRACT(YEAR FROM posted)::int, EXTRACT(MONTH FROM posted)::int, COUNT(*)
+      FROM new_rows
+      WHERE posted IS NOT NULL AND repo IS NOT NULL
+      GROUP BY 1, 2, 3
+    ON CONFLICT (repo, year, month) DO UPDATE SET submissions = prod.monthly_stats.submissions + EXCLUDED.submissions;
+  ELSIF TG_OP = 'DELETE' THEN
+    UPDATE prod.monthly_stats m
+    SET submissions = m.submissions - old.submissions
+    FROM (
+      SELECT repo, EXTRACT(YEAR FROM posted)::int AS year, EXTRACT(MONTH FROM posted)::int AS month, COUNT(*) AS submissions
+      FROM old_rows
+      WHERE posted IS NOT NULL AND repo IS NOT NULL
+      GROUP BY 1, 2, 3
+    ) AS old
+    WHERE m.repo = old.repo AND m.year = old.year AND m.month = old.month;
+  ELSE
+    INSERT INTO prod.monthly_stats (repo, year, month, submissions)
+      SELECT repo, year, month, SUM(delta)
+      FROM (
+        SELECT repo, EXTRACT(YEAR FROM posted)::int AS year, EXTRACT(MONTH FROM posted)::int AS month, 1 AS delta
+        FROM new_rows WHERE posted IS NOT NULL AND repo IS NOT NULL
+        UNION ALL
+        SELECT repo, EXTRACT(YEAR FROM posted)::int, EXTRACT(MONTH FROM posted)::int, -1
+        FROM old_rows WHERE posted IS NOT NULL AND repo IS NOT NULL
+      ) AS changes
+      GROUP BY 1, 2, 3
+      HAVING SUM(delta) != 0
+    ON CONFLICT (repo, year, month) DO UPDATE SET submissions = prod.monthly_stats.submissions + EXCLUDED.submissions;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The same, for the downloads recorded in article_traffic. (Traffic
+-- rows are matched to a repository through articles, so downloads for
+-- a paper that's deleted before its traffic rows stay counted.)
+CREATE OR REPLACE FUNCTION prod.update_monthly_downloads() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO prod.monthly_stats (repo, year, month, downloads)
+      SELECT a.repo, n.year, n.month, SUM(n.pdf)
+      FROM new_rows n
+      INNER JOIN prod.articles a ON n.article=a.id
+      WHERE a.repo IS NOT NULL
+      GROUP BY 1, 2, 3
+    ON CONFLICT (repo, year, month) DO UPDATE SET downloads = prod.monthly_stats.downloads + EXCLUDED.downloads;
+  ELSIF TG_OP = 'DELETE' THEN
+    UPDATE prod.monthly_stats m
+    SET downloads = m.downloads - old.downloads
+    FROM (
+      SELECT a.repo, o.year, o.month, SUM(o.pdf) AS downloads
+      FROM old_rows o
+      INNER JOIN prod.articles a ON o.article=a.id
+      WHERE a.repo IS NOT NULL
+      GROUP BY 1, 2, 3
+    ) AS old
+    WHERE m.repo = old.repo AND m.year = old.year AND m.month = old.month;
+  ELSE
+    INSERT INTO prod.monthly_stats (repo, year, month, downloads)
+      SELECT a.repo, changes.year, changes.month, SUM(changes.pdf)
+      FROM (
+        SELECT article, year, month, pdf FROM new_rows
+        UNION ALL
+        SELECT article, year, month, -pdf FROM old_rows
+      ) AS changes
+      INNER JOIN prod.articles a ON changes.article=a.id
+      WHERE a.repo IS NOT NULL
+      GROUP BY 1, 2, 3
+      HAVING SUM(changes.pdf) != 0
+    ON CONFLICT (repo, year, month) DO UPDATE SET downloads = prod.monthly_stats.downloads + EXCLUDED.downloads;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS articles_insert_monthly ON prod.articles;
+CREATE TRIGGER articles_insert_monthly
+  AFTER INSERT ON prod.articles
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.update_monthly_submissions();
+
+DROP TRIGGER IF EXISTS articles_update_monthly ON prod.articles;
+CREATE TRIGGER articles_update_monthly
+  AFTER UPDATE ON prod.articles
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.update_monthly_submissions();
+
+DROP TRIGGER IF EXISTS articles_delete_monthly ON prod.articles;
+CREATE TRIGGER articles_delete_monthly
+  AFTER DELETE ON prod.articles
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.update_monthly_submissions();
+
+DROP TRIGGER IF EXISTS article_traffic_insert_monthly ON prod.article_traffic;
+CREATE TRIGGER article_traffic_insert_monthly
+  AFTER INSERT ON prod.article_traffic
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.update_monthly_downloads();
+
+DROP TRIGGER IF EXISTS article_traffic_update_monthly ON prod.article_traffic;
+CREATE TRIGGER article_traffic_update_monthly
+  AFTER UPDATE ON prod.article_traffic
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.update_monthly_downloads();
+
+DROP TRIGGER IF EXISTS article_traffic_delete_monthly ON prod.article_traffic;
+CREATE TRIGGER article_traffic_delete_monthly
+  AFTER DELETE ON prod.article_traffic
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.update_monthly_downloads();
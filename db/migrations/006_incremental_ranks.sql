@@ -0,0 +1,199 @@
+-- Incremental updates for the all-time download rankings of papers
+-- (alltime_ranks) and authors (author_ranks), so the spider doesn't have
+-- to re-sort the whole corpus when only some papers have new download
+-- numbers.
+--
+-- Every statement that writes to article_traffic queues the papers it
+-- touched in rank_changes_pending. refresh_ranks_incremental() then
+-- works out the new totals for just those papers (and their authors),
+-- and moves every other row's rank by the number of changed rows that
+-- passed it in either direction. Ranks follow the same rules as
+-- RANK(): a row's rank is one more than the number of rows with more
+-- downloads, so tied rows share a rank and the next rank is skipped.
+-- (The tables must have been built that way for the adjustments to
+-- hold.)
+--
+-- Everything happens in the caller's transaction, so the API keeps
+-- reading the previous rankings until all of the changes are committed.
+
+CREATE TABLE IF NOT EXISTS prod.rank_changes_pending (
+  article integer PRIMARY KEY
+);
+
+CREATE INDEX IF NOT EXISTS alltime_ranks_downloads ON prod.alltime_ranks (downloads);
+CREATE INDEX IF NOT EXISTS author_ranks_downloads ON prod.author_ranks (downloads);
+
+CREATE OR REPLACE FUNCTION prod.queue_rank_changes() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO prod.rank_changes_pending (article)
+      SELECT DISTINCT article FROM new_rows
+    ON CONFLICT DO NOTHING;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO prod.rank_changes_pending (article)
+      SELECT DISTINCT article FROM old_rows
+    ON CONFLICT DO NOTHING;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS article_traffic_insert_ranks ON prod.article_traffic;
+CREATE TRIGGER article_traffic_insert_ranks
+  AFTER INSERT ON prod.article_traffic
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.queue_rank_changes();
+
+DROP TRIGGER IF EXISTS article_traffic_update_ranks ON prod.article_traffic;
+CREATE TRIGGER article_traffic_update_ranks
+  AFTER UPDATE ON prod.article_traffic
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.queue_rank_changes();
+
+DROP TRIGGER IF EXISTS article_traffic_delete_ranks ON prod.article_traffic;
+CREATE TRIGGER article_traffic_delete_ranks
+  AFTER DELETE ON prod.article_traffic
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE prod.queue_rank_changes();
+
+-- Applies the download totals in the rank_changes temporary table
+-- (id, old, new) to a ranking table with "rank" and "downloads" columns.
+-- "old" is -1 for rows that weren't ranked before, and "new" is -1 for
+-- rows that should be dropped. If the table has a "tie" column, it's
+-- updated for every row sharing a total with a row that moved.
+CREATE OR REPLACE FUNCTION prod.apply_rank_changes(rank_table text, key_column text, has_tie boolean) RETURNS void AS $$
+BEGIN
+  DELETE FROM rank_changes WHERE old = new;
+
+  -- Move the unchanged rows: each changed row that went from below a
+  -- row's total to above it pushes that row down a place, and each one
+  -- that went the other way pulls it up. Only rows with totals between
+  -- a changed row's old and new totals can be affected.
+  EXECUTE format($q$
+    UPDATE prod.%1$I r
+    SET rank = r.rank + s.shift
+    FROM (
+      SELECT r.%2$I AS id, SUM((c.new > r.downloads)::int - (c.old > r.downloads)::int) AS shift
+      FROM prod.%1$I r
+      INNER JOIN rank_changes c
+        ON r.downloads >= LEAST(c.old, c.new) AND r.downloads < GREATEST(c.old, c.new)
+      WHERE NOT EXISTS (SELECT 1 FROM rank_changes x WHERE x.id = r.%2$I)
+      GROUP BY r.%2$I
+    ) AS s
+    WHERE r.%2$I = s.id AND s.shift != 0
+  $q$, rank_table, key_column);
+
+  -- Record the changed rows' new totals
+  EXECUTE format($q$
+    DELETE FROM prod.%1$I r USING rank_changes c
+    WHERE r.%2$I = c.id AND c.new < 0
+  $q$, rank_table, key_column);
+  EXECUTE format($q$
+    UPDATE prod.%1$I r SET downloads = c.new
+    FROM rank_changes c
+    WHERE r.%2$I = c.id AND c.new >= 0
+  $q$, rank_table, key_column);
+  EXECUTE format($q$
+    INSERT INTO prod.%1$I (%2$I, rank, downloads%3$s)
+      SELECT c.id, 0, c.new%4$s
+      FROM rank_changes c
+      WHERE c.new >= 0 AND NOT EXISTS (SELECT 1 FROM prod.%1$I r WHERE r.%2$I = c.id)
+  $q$, rank_table, key_column,
+    CASE WHEN has_tie THEN ', tie' ELSE '' END,
+    CASE WHEN has_tie THEN ', false' ELSE '' END);
+
+  -- Rank the changed rows. The rows above one are the changed rows with
+  -- a higher total, plus the unchanged rows with a higher total. The
+  -- latter is worked out from the closest unchanged row above it, whose
+  -- rank is already correct, rather than by counting them all.
+  EXECUTE format($q$
+    UPDATE prod.%1$I r
+    SET rank = 1 + above.changed + above.unchanged
+    FROM (
+      SELECT c.id,
+        RANK() OVER (ORDER BY c.new DESC) - 1 AS changed,
+        COALESCE((
+          SELECT u.rank - 1
+            - (SELECT COUNT(*) FROM rank_changes x WHERE x.new > u.downloads)
+            + (SELECT COUNT(*) FROM prod.%1$I t
+                WHERE t.downloads = u.downloads
+                AND NOT EXISTS (SELECT 1 FROM rank_changes x WHERE x.id = t.%2$I))
+          FROM prod.%1$I u
+          WHERE u.downloads > c.new
+            AND NOT EXISTS (SELECT 1 FROM rank_changes x WHERE x.id = u.%2$I)
+          ORDER BY u.downloads ASC
+          LIMIT 1
+        ), 0) AS unchanged
+      FROM rank_changes c
+      WHERE c.new >= 0
+    ) AS above
+    WHERE r.%2$I = above.id
+  $q$, rank_table, key_column);
+
+  IF has_tie THEN
+    EXECUTE format($q$
+      UPDATE prod.%1$I r
+      SET tie = (SELECT COUNT(*) FROM prod.%1$I t WHERE t.downloads = r.downloads) > 1
+      WHERE r.downloads IN (SELECT old FROM rank_changes UNION SELECT new FROM rank_changes)
+    $q$, rank_table);
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Brings alltime_ranks and author_ranks up to date with the papers queued
+-- in rank_changes_pending. Returns the number of papers whose totals changed.
+CREATE OR REPLACE FUNCTION prod.refresh_ranks_incremental() RETURNS integer AS $$
+DECLARE
+  total integer;
+BEGIN
+  DROP TABLE IF EXISTS pending_articles;
+  CREATE TEMPORARY TABLE pending_articles ON COMMIT DROP AS
+    WITH taken AS (DELETE FROM prod.rank_changes_pending RETURNING article)
+    SELECT DISTINCT article FROM taken;
+
+  DROP TABLE IF EXISTS rank_changes;
+  CREATE TEMPORARY TABLE rank_changes (id integer PRIMARY KEY, old bigint NOT NULL, new bigint NOT NULL) ON COMMIT DROP;
+
+  -- Papers
+  INSERT INTO rank_changes (id, old, new)
+    SELECT p.article, COALESCE(r.downloads, -1), COALESCE(t.downloads, -1)
+    FROM pending_articles p
+    LEFT JOIN prod.alltime_ranks r ON r.article = p.article
+    LEFT JOIN (
+      SELECT t.article, SUM(t.pdf) AS downloads
+      FROM prod.article_traffic t
+      INNER JOIN prod.articles a ON a.id = t.article
+      WHERE t.article IN (SELECT article FROM pending_articles)
+      GROUP BY t.article
+    ) AS t ON t.article = p.article;
+  SELECT COUNT(*) INTO total FROM rank_changes WHERE old != new;
+  PERFORM prod.apply_rank_changes('alltime_ranks', 'article', false);
+
+  -- Authors of those papers
+  TRUNCATE rank_changes;
+  INSERT INTO rank_changes (id, old, new)
+    SELECT w.author, COALESCE(r.downloads, -1), COALESCE(t.downloads, -1)
+    FROM (
+      SELECT DISTINCT aa.author
+      FROM prod.article_authors aa
+      WHERE aa.article IN (SELECT article FROM pending_articles)
+    ) AS w
+    LEFT JOIN prod.author_ranks r ON r.author = w.author
+    LEFT JOIN (
+      SELECT aa.author, SUM(ar.downloads) AS downloads
+      FROM prod.article_authors aa
+      INNER JOIN prod.alltime_ranks ar ON ar.article = aa.article
+      WHERE aa.author IN (
+        SELECT author FROM prod.article_authors
+        WHERE article IN (SELECT article FROM pending_articles)
+      )
+      GROUP BY aa.author
+    ) AS t ON t.author = w.author;
+  PERFORM prod.apply_rank_changes('author_ranks', 'author', true);
+
+  ANALYZE prod.alltime_ranks;
+  ANALYZE prod.author_ranks;
+  RETURN total;
+END;
+$$ LANGUAGE plpgsql;
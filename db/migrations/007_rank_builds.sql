@@ -0,0 +1,137 @@
+-- Lets the spider rebuild a ranking table (alltime_ranks, ytd_ranks,
+-- month_ranks, category_ranks, author_ranks or author_ranks_category)
+-- without the API ever reading it half-built:
+--
+--   SELECT prod.begin_rank_build('alltime_ranks');
+--     -- creates an empty copy named alltime_ranks_build
+--   (fill alltime_ranks_build with the new rankings)
+--   SELECT prod.finish_rank_build('alltime_ranks');
+--     -- indexes and analyzes the copy, then swaps it in
+--
+-- The copy gets the same indexes, primary key, owner and privileges as
+-- the live table, but the indexes are only built after it's been filled,
+-- which is much faster than updating them row by row. The swap happens
+-- at the very end of finish_rank_build(), so the live table is locked
+-- only for as long as it takes to rename the tables, and queries see
+-- either the old rankings or the new ones.
+--
+-- Taking that lock means waiting for every query already reading the live
+-- table to finish, and API queries that arrive in the meantime queue up
+-- behind it. So finish_rank_build() waits no longer than lock_wait (a
+-- tenth of a second, by default) for the lock before giving up, letting
+-- the queued queries through, and trying again half a second later, up
+-- to lock_attempts times:
+--
+--   SELECT prod.finish_rank_build('alltime_ranks', '50 milliseconds', 200);
+--
+-- Every build is recorded in rank_builds, along with how long it took
+-- and how many rows it produced, which the API reports at
+-- /v1/data/server (see the debug_parameter setting in the API's config).
+
+CREATE TABLE IF NOT EXISTS prod.rank_builds (
+  id serial PRIMARY KEY,
+  rank_table text NOT NULL,
+  started timestamp with time zone NOT NULL,
+  finished timestamp with time zone,
+  row_count bigint
+);
+
+CREATE INDEX IF NOT EXISTS rank_builds_table_finished ON prod.rank_builds (rank_table, finished);
+
+CREATE OR REPLACE FUNCTION prod.begin_rank_build(rank_table text) RETURNS text AS $$
+DECLARE
+  shadow text := rank_table || '_build';
+BEGIN
+  EXECUTE format('DROP TABLE IF EXISTS prod.%I', shadow);
+  EXECUTE format('CREATE TABLE prod.%I (LIKE prod.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', shadow, rank_table);
+  INSERT INTO prod.rank_builds (rank_table, started) VALUES (rank_table, clock_timestamp());
+  RETURN shadow;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS prod.finish_rank_build(text);
+DROP FUNCTION IF EXISTS prod.finish_rank_build(text, interval, integer);
+CREATE OR REPLACE FUNCTION prod.finish_rank_build(rank_table text, lock_wait interval DEFAULT '100 milliseconds', lock_attempts integer DEFAULT 60) RETURNS bigint AS $$
+DECLARE
+  shadow text := rank_table || '_build';
+  idx record;
+  acl record;
+  owner_name text;
+  index_names text[] := '{}';
+  constraint_names text[] := '{}';
+  constraint_types text[] := '{}';
+  total bigint;
+  previous_timeout text := current_setting('lock_timeout');
+BEGIN
+  -- Copy the live table's indexes onto the shadow table
+  FOR idx IN
+    SELECT c.relname AS name, pg_get_indexdef(i.indexrelid) AS def,
+      con.conname, con.contype
+    FROM pg_index i
+    INNER JOIN pg_class c ON c.oid = i.indexrelid
+    LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid AND con.conrelid = i.indrelid
+    WHERE i.indrelid = format('prod.%I', rank_table)::regclass
+  LOOP
+    EXECUTE regexp_replace(idx.def, '^(CREATE (UNIQUE )?INDEX )\S+ ON (ONLY )?\S+',
+      '\1' || quote_ident(idx.name || '_build') || ' ON prod.' || quote_ident(shadow));
+    index_names := index_names || idx.name::text;
+    constraint_names := constraint_names || idx.conname::text;
+    constraint_types := constraint_types || idx.contype::text;
+  END LOOP;
+
+  EXECUTE format('ANALYZE prod.%I', shadow);
+  EXECUTE format('SELECT COUNT(*) FROM prod.%I', shadow) INTO total;
+
+  -- Give the shadow table the live table's owner and privileges (such as
+  -- the API's SELECT), which would otherwise be dropped along with it
+  SELECT pg_get_userbyid(c.relowner) INTO owner_name
+  FROM pg_class c WHERE c.oid = format('prod.%I', rank_table)::regclass;
+  EXECUTE format('ALTER TABLE prod.%I OWNER TO %I', shadow, owner_name);
+  FOR acl IN
+    SELECT a.grantee, a.privilege_type, a.is_grantable
+    FROM pg_class c, aclexplode(c.relacl) a
+    WHERE c.oid = format('prod.%I', rank_table)::regclass
+  LOOP
+    EXECUTE format('GRANT %s ON prod.%I TO %s%s', acl.privilege_type, shadow,
+      CASE WHEN acl.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(acl.grantee)) END,
+      CASE WHEN acl.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END);
+  END LOOP;
+
+  -- Swap the tables
+  PERFORM set_config('lock_timeout', (extract(epoch FROM lock_wait) * 1000)::bigint::text, true);
+  FOR attempt IN 1..lock_attempts LOOP
+    BEGIN
+      EXECUTE format('LOCK TABLE prod.%I IN ACCESS EXCLUSIVE MODE', rank_table);
+      EXIT;
+    EXCEPTION WHEN lock_not_available THEN
+      IF attempt = lock_attempts THEN
+        RAISE;
+      END IF;
+      RAISE NOTICE 'Timed out waiting to lock %; trying again.', rank_table;
+      PERFORM pg_sleep(0.5);
+    END;
+  END LOOP;
+  PERFORM set_config('lock_timeout', previous_timeout, true);
+  EXECUTE format('DROP TABLE prod.%I', rank_table);
+  EXECUTE format('ALTER TABLE prod.%I RENAME TO %I', shadow, rank_table);
+  FOR n IN 1..coalesce(array_length(index_names, 1), 0) LOOP
+    IF constraint_types[n] IN ('p', 'u') THEN
+      -- (this also gives the index the constraint's name)
+      EXECUTE format('ALTER TABLE prod.%I ADD CONSTRAINT %I %s USING INDEX %I',
+        rank_table, constraint_names[n],
+        CASE constraint_types[n] WHEN 'p' THEN 'PRIMARY KEY' ELSE 'UNIQUE' END,
+        index_names[n] || '_build');
+    ELSE
+      EXECUTE format('ALTER INDEX prod.%I RENAME TO %I', index_names[n] || '_build', index_names[n]);
+    END IF;
+  END LOOP;
+
+  UPDATE prod.rank_builds
+  SET finished = clock_timestamp(), row_count = total
+  WHERE id = (
+    SELECT MAX(id) FROM prod.rank_builds b
+    WHERE b.rank_table = finish_rank_build.rank_table AND b.finished IS NULL
+  );
+  RETURN total;
+END;
+$$ LANGUAGE plpgsql;
@@ -1,10 +1,16 @@
 """Functions linked directly to functionality called from API endpoints.
 
 """
+import csv
 from datetime import datetime
+import io
+import json
+import threading
+import zlib
 
 import bottle
 
+import cache
 import config
 import db
 import helpers
@@ -15,16 +21,45 @@ def get_categories(connection,repo='all'):
 
   bioRxiv separates all papers into categories (or "collections"), such
   as "bioinformatics", "genomics", etc. This function lists all the ones
-  we've pulled from the site so far.
+  we've pulled from the site so far. The lists are remembered until
+  the data version changes.
 
   Arguments:
     - connection: a Connection object with an active database session
+    - repo: The repository to list categories for, or "all"
 
   Returns:
     - a list of strings, one for each collection
 
   """
-  results = []
+  return list(_category_lists(connection, repo)[0])
+
+def is_category(category, connection, repo='all'):
+  """Determines whether a paper category is known for the given repository,
+  without searching the articles table every time.
+
+  Arguments:
+    - category: The category name to look up
+    - connection: a Connection object with an active database session
+    - repo: The repository the category should belong to, or "all"
+
+  Returns:
+    - True if at least one paper from the repository is in the category
+
+  """
+  return category in _category_lists(connection, repo)[1]
+
+def _category_lists(connection, repo):
+  """Fetches the categories for a repository, or finds them in cache.categories.
+
+  Returns:
+    - A tuple of category names, in alphabetical order
+    - A frozenset of the same names, for quick lookups
+
+  """
+  entry = cache.categories.get(repo)
+  if entry is not None:
+    return entry
   query = """
     SELECT DISTINCT collection
     FROM articles
@@ -36,13 +71,12 @@ def get_categories(connection,repo='all'):
   else:
     params = ()
   query += " ORDER BY collection"
-  categories = connection.read(query, params)
-  for cat in categories:
-    if len(cat) > 0:
-      results.append(cat[0])
-  return results
+  categories = tuple(cat[0] for cat in connection.read(query, params) if len(cat) > 0)
+  entry = (categories, frozenset(categories))
+  cache.categories.put(repo, entry)
+  return entry
 
-def paper_query(q, categories, timeframe, metric, page, page_size, repo, version, connection):
+def paper_query(q, categories, timeframe, metric, page, page_size, repo, version, connection, cursor=None, sort="metric"):
   """Returns a list of the most downloaded papers that meet a given set of constraints.
 
   Arguments:
@@ -55,22 +89,25 @@ def paper_query(q, categories, timeframe, metric, page, page_size, repo, version
     - metric: Which article-level statistic to use when sorting results
     - page: Which page of the results to display (0-indexed)
     - page_size: How many entries should be returned
+    - cursor: (Optionally) the sort key of the last result of the previous
+          page, as decoded from a next_cursor value. When this is set, the
+          page begins directly after that result and "page" is ignored.
+    - sort: "metric" to order results by the specified metric, or
+          "relevance" to order them by how well they match the text search.
   Returns:
     - An list of Article objects that meet the search criteria, sorted by the
           specified metric in descending order.
+    - The total number of results
+    - How the total was determined: "exact", "cached" or "estimated"
+    - The sort key of the last result on the page, to be used as the
+          cursor for the next page, or None if this is the last page.
 
   """
 
-  # HACK: Because there are so many possible combinations for which
-  # parameters need to be passed to the database for this query,
-  # it's much easier to say that every query needs a "repo" parameter
-  # rather than having lots of nested options in which some of them
-  # are performed without any repository clause.
-  if repo == 'all':
-    repo = ['biorxiv','medrxiv']
-  else:
-    repo = [repo]
-
+  # Download rankings are always read from precomputed tables. Twitter
+  # rankings are too, unless they're configured to be calculated from
+  # the raw crossref data on every request.
+  ranked = metric == "downloads" or config.twitter_rank_tables
 
   # We build two queries, 'select' and 'countselect': one to get the
   # current page of results, and one to figure out the total number
@@ -78,96 +115,376 @@ def paper_query(q, categories, timeframe, metric, page, page_size, repo, version
   select = "SELECT "
   if metric == "downloads":
     select += "r.downloads"
-  elif metric == "twitter":
+  elif ranked:
+    select += "r.tweets"
+  else:
     select += "SUM(r.count)"
   select += ", a.id, a.url, a.title, a.abstract, a.collection, a.posted, a.doi, a.repo"
+  if ranked:
+    select += ", r.rank"
+  if sort == "relevance":
+    relevance = f"ts_rank_cd({_search_vector()}, query)::float8"
+    if not ranked: # grouped by article
+      relevance = f"MAX({relevance})"
+    select += f", {relevance}"
 
   countselect = "SELECT COUNT(DISTINCT a.id)"
-  params = (repo,)
+  query, params = _paper_filters(q, categories, timeframe, metric, repo, version)
+  count_params = params
+
+  # this is the last piece of the query we need for the one
+  # that counts the total number of results
+  countselect += query
+  total = None
+  count = None # a separate lookup for the total, if one is needed
+  strategy = config.paper_count["strategy"]
+  # The window function counts only the rows after the cursor,
+  # so it's no help when we're using one:
+  use_window = strategy == "window" and cursor is None
+  if q != "" and config.paper_count["estimate_text_search"]:
+    count = lambda: (_estimated_count(query, count_params, metric, connection), "estimated")
+  elif not use_window:
+    count = lambda: _count(countselect, count_params, strategy != "separate", connection)
+  else:
+    select += ", COUNT(*) OVER ()"
+  # continue building the query to get the full list of results.
+  # If we have a cursor, skip straight to the rows that come after
+  # it (in the order below) instead of counting through an OFFSET:
+  if cursor is not None and sort == "metric" and ranked:
+    query += " AND (r.rank, a.id) > (%s, %s)"
+    params += (cursor[0], cursor[1])
+  if not ranked:
+    query += " GROUP BY a.id"
+  if cursor is not None and (sort == "relevance" or not ranked):
+    # (these sort keys are descending, so they can't be compared as a row)
+    key = relevance if sort == "relevance" else "SUM(r.count)"
+    seek = f"({key} < %s OR ({key} = %s AND a.id > %s))"
+    # aggregates have to be compared after grouping:
+    query += f" HAVING {seek}" if not ranked else f" AND {seek}"
+    params += (cursor[0], cursor[0], cursor[1])
+  query += " ORDER BY "
+  if sort == "relevance":
+    query += f"{relevance} DESC, a.id ASC"
+  elif ranked:
+    query += "r.rank ASC, a.id ASC"
+  else:
+    query += "SUM(r.count) DESC, a.id ASC"
+
+  # The page size and offset are sent as parameters so that every
+  # page of a search uses the same prepared statement:
+  query += " LIMIT %s"
+  params += (page_size,)
+  if page > 0 and cursor is None:
+    query += " OFFSET %s"
+    params += (page * page_size,)
+  query += ";"
+
+  select += query
+  if count is None:
+    result = connection.read(select, params, prepare=True)
+  else: # the total doesn't depend on the page, so look up both at once
+    result, (total, count_type) = connection.concurrently(
+      lambda: connection.read(select, params, prepare=True),
+      count
+    )
+  if cursor is None and (len(result) > 0 or page == 0) and len(result) < page_size:
+    # if this is the last page, we know exactly how many results there are
+    total, count_type = (page * page_size) + len(result), "exact"
+  elif use_window and total is None:
+    if len(result) > 0:
+      total, count_type = result[0][-1], "exact"
+    else: # past the last page
+      total, count_type = _count(countselect, count_params, True, connection)
+  authors = models.get_authors_bulk([a[1] for a in result], connection, as_json=True)
+  results = [models.SearchResultArticle(a, connection, authors[a[1]]) for a in result]
+
+  next_cursor = None
+  if len(result) == page_size and page_size > 0:
+    last = result[-1]
+    if sort == "relevance":
+      next_cursor = [last[10] if ranked else last[9], last[1]]
+    elif ranked:
+      next_cursor = [last[9], last[1]]
+    else:
+      next_cursor = [last[0], last[1]]
+  return results, total, count_type, next_cursor
+
+def front_page_ranking(q, categories, repo, version, connection):
+  """Picks the ranking to use when a paper search doesn't specify one:
+  tweets over the last day, unless fewer than config.min_daily_twitter
+  papers have any, in which case tweets over the last week, unless fewer
+  than config.min_weekly_twitter papers have any, in which case
+  downloads over the last month. The daily and weekly counts are fetched
+  in a single query and remembered until the data version changes.
+
+  Arguments:
+    - The search parameters, as described in paper_query()
+  Returns:
+    - The metric and timeframe to rank the results by
+
+  """
+  day_query, day_params = _paper_filters(q, categories, "day", "twitter", repo, version)
+  week_query, week_params = _paper_filters(q, categories, "week", "twitter", repo, version)
+  sql = f"SELECT (SELECT COUNT(DISTINCT a.id) {day_query}), (SELECT COUNT(DISTINCT a.id) {week_query})"
+  params = day_params + week_params
+
+  key = f"{sql}{params}"
+  counts = cache.counts.get(key)
+  if counts is None:
+    counts = connection.read(sql, params)[0]
+    cache.counts.put(key, counts)
+  if counts[0] >= config.min_daily_twitter:
+    return "twitter", "day"
+  if counts[1] >= config.min_weekly_twitter:
+    return "twitter", "week"
+  return "downloads", "lastmonth"
+
+def _search_vector():
+  """The SQL for the weighted text search vector of each paper ("a"): the
+  indexed column from db/migrations/004_search_vector.sql if it's enabled
+  in config.search_vector_column, or else the same vector built from the
+  title, abstract and author vectors."""
+  if config.search_vector_column:
+    return "a.search_vector"
+  return "coalesce(setweight(a.title_vector, 'A') || setweight(a.abstract_vector, 'C') || setweight(a.author_vector, 'D'))"
+
+def _paper_filters(q, categories, timeframe, metric, repo, version):
+  """Builds the FROM and WHERE clauses shared by every query that searches
+  for papers: the ranking table for the given metric and timeframe, plus
+  any text, category and repository filters.
+
+  Arguments:
+    - The search parameters, as described in paper_query()
+  Returns:
+    - The SQL for the FROM and WHERE clauses. Search results should be
+        selected from "a" (articles) and "r" (rankings).
+    - The parameters to send along with the query
+
+  """
+  ranked = metric == "downloads" or config.twitter_rank_tables
+
+  # HACK: Because there are so many possible combinations for which
+  # parameters need to be passed to the database for this query,
+  # it's much easier to say that every query needs a "repo" parameter
+  # rather than having lots of nested options in which some of them
+  # are performed without any repository clause.
+  if repo == 'all':
+    repo = ['biorxiv','medrxiv']
+  else:
+    repo = [repo]
 
+  params = (repo,)
   query = ""
   if q != "": # if there's a text search specified
     params = (q,repo)
   query += f' FROM {config.db["schema"]}.articles AS a INNER JOIN {config.db["schema"]}.'
-  if metric == "twitter":
-    query += "crossref_daily"
-  elif metric == "downloads":
+  if metric == "downloads":
     query_times = {
       "alltime": "alltime_ranks",
       "ytd": "ytd_ranks",
       "lastmonth": "month_ranks",
     }
     query += query_times[timeframe]
+  elif ranked:
+    query += f"twitter_{timeframe}_ranks"
+  else:
+    query += "crossref_daily"
 
-  if metric == "twitter":
-    query += " AS r ON r.doi=a.doi"
-  elif metric == "downloads":
+  if ranked:
     query += " AS r ON r.article=a.id"
+  else:
+    query += " AS r ON r.doi=a.doi"
 
   if q != "":
     # backwards compatibility for text search
     if version == 1:
-      query += """, plainto_tsquery(%s) query,
-      coalesce(setweight(a.title_vector, 'A') || setweight(a.abstract_vector, 'C') || setweight(a.author_vector, 'D')) totalvector
-      """
+      query += ", plainto_tsquery(%s) query"
     else:
-      query += """, websearch_to_tsquery(%s) query,
-      coalesce(setweight(a.title_vector, 'A') || setweight(a.abstract_vector, 'C') || setweight(a.author_vector, 'D')) totalvector
-      """
-  # add a WHERE clause if we need one:
-  # (all-time twitter stats don't require it)
-  query += f" WHERE a.repo=ANY(%s)"
-  if metric == "downloads" or (metric == "twitter" and timeframe != "alltime") or len(categories) > 0:
-    query += " AND "
-    if metric == "downloads":
-      query += "r.downloads > 0"
-      if q != "" or len(categories) > 0:
-        query += " AND "
-    if q != "":
-      query += "query @@ totalvector "
-      if len(categories) > 0 or (metric == "twitter" and timeframe != "alltime"):
-        query += " AND "
-
-    if len(categories) > 0:
-      query += "collection=ANY(%s)"
-      if q != "":
-        params = (q,repo,categories)
-      else:
-        params = (repo,categories)
-      if metric == "twitter" and timeframe != "alltime":
-        query += " AND "
-    if metric == "twitter" and timeframe != "alltime":
-      query += "r.source_date > now() - interval "
-      query_times = {
-        "day": 2,
-        "week": 7,
-        "month": 30,
-        "year": 365
-      }
-      query += f"'{query_times[timeframe]} days' "
-  # this is the last piece of the query we need for the one
-  # that counts the total number of results
-  countselect += query
-  resp = connection.read(countselect, params)
-  total = resp[0][0]
-  # continue building the query to get the full list of results:
-  if metric == "twitter":
-    query += " GROUP BY a.id"
-  query += " ORDER BY "
+      query += ", websearch_to_tsquery(%s) query"
+  # build the WHERE clause:
+  conditions = ["a.repo=ANY(%s)"]
   if metric == "downloads":
-    query += "r.rank ASC"
-  elif metric == "twitter":
-    query += "SUM(r.count) DESC"
+    conditions.append("r.downloads > 0")
+  if q != "":
+    conditions.append(f"{_search_vector()} @@ query")
+  if len(categories) > 0:
+    conditions.append("collection=ANY(%s)")
+    params += (categories,)
+  # (all-time twitter stats don't need a date range)
+  if not ranked and timeframe != "alltime":
+    query_times = {
+      "day": 2,
+      "week": 7,
+      "month": 30,
+      "year": 365
+    }
+    conditions.append("r.source_date > now() - %s::interval")
+    params += (f"{query_times[timeframe]} days",)
+  query += " WHERE " + " AND ".join(conditions)
+  return query, params
 
-  query += f" LIMIT {page_size}"
-  if page > 0:
-    query += f" OFFSET {page * page_size}"
-  query += ";"
+def _count(countselect, params, use_cache, connection):
+  """Runs the query counting the total results of a paper search.
 
-  select += query
-  result = connection.read(select, params)
-  results = [models.SearchResultArticle(a, connection) for a in result]
-  return results, total
+  Arguments:
+    - countselect: The counting query built by paper_query()
+    - params: The parameters to send with the query
+    - use_cache: Whether a count remembered from an earlier request
+        with the same filters can be used.
+    - connection: a database Connection object.
+  Returns:
+    - The number of results
+    - "cached" if the count was remembered, "exact" if it was just counted
+
+  """
+  key = f"{countselect}{params}"
+  if use_cache:
+    total = cache.counts.get(key)
+    if total is not None:
+      return total, "cached"
+  total = connection.read(countselect, params, prepare=True)[0][0]
+  cache.counts.put(key, total)
+  return total, "exact"
+
+def _estimated_count(query, params, metric, connection):
+  """Asks the Postgres query planner how many results a paper search
+  will return, which is much cheaper than counting them but can
+  be wildly wrong.
+
+  Arguments:
+    - query: The FROM and WHERE clauses built by paper_query()
+    - params: The parameters to send with the query
+    - metric: The metric the results are ranked by
+    - connection: a database Connection object.
+  Returns:
+    - The estimated number of results
+
+  """
+  sql = f"EXPLAIN (FORMAT JSON) SELECT a.id {query}"
+  if metric == "twitter" and not config.twitter_rank_tables:
+    sql += " GROUP BY a.id"
+  plan = connection.read(sql, params)[0][0]
+  if isinstance(plan, str):
+    plan = json.loads(plan)
+  return int(plan[0]["Plan"]["Plan Rows"])
+
+# Each export keeps a connection from the pool for as long as the client
+# takes to download it, so only a few can run at once
+exports = threading.BoundedSemaphore(config.export["max_concurrent"])
+
+def export_papers(fmt, traffic, connection):
+  """Generates a gzip-compressed dump of every paper, including its
+  authors and download rankings (and, optionally, its monthly download
+  stats). The rows are read from a server-side cursor and compressed as
+  they arrive, so the whole dataset is never held in memory.
+
+  Arguments:
+    - fmt: "ndjson" for one JSON object per line, or "csv"
+    - traffic: Whether to include each paper's monthly traffic
+    - connection: a database Connection object.
+  Returns:
+    - A generator of compressed chunks of the file
+  Raises:
+    - helpers.BusyError: if config.export["max_concurrent"] exports are
+        already running
+
+  """
+  if not exports.acquire(blocking=False):
+    raise helpers.BusyError("Too many exports are already running.")
+  return _export_chunks(fmt, traffic, connection)
+
+def _export_chunks(fmt, traffic, connection):
+  """Builds the file for export_papers(), and lets another export start
+  once it's finished (or the client has gone away)."""
+  try:
+    yield from _export_file(fmt, traffic, connection)
+  finally:
+    exports.release()
+
+def _export_file(fmt, traffic, connection):
+  """Builds the file for export_papers()."""
+  sql = f"""
+    SELECT a.id, a.doi, a.title, a.url, a.repo, a.collection, a.posted, a.abstract,
+      alltime_ranks.rank, alltime_ranks.downloads, ytd_ranks.rank, ytd_ranks.downloads,
+      month_ranks.rank, month_ranks.downloads, category_ranks.rank,
+      (
+        SELECT json_agg(json_build_object('id', au.id, 'name', au.name) ORDER BY aa.id)
+        FROM {config.db["schema"]}.article_authors aa
+        INNER JOIN {config.db["schema"]}.authors au ON au.id=aa.author
+        WHERE aa.article=a.id
+      )
+  """
+  if traffic:
+    sql += f""",
+      (
+        SELECT json_agg(json_build_object('month', t.month, 'year', t.year, 'downloads', t.pdf, 'views', t.abstract) ORDER BY t.year, t.month)
+        FROM {config.db["schema"]}.article_traffic t
+        WHERE t.article=a.id
+      )
+    """
+  sql += f"""
+    FROM {config.db["schema"]}.articles a
+    LEFT JOIN {config.db["schema"]}.alltime_ranks ON a.id=alltime_ranks.article
+    LEFT JOIN {config.db["schema"]}.ytd_ranks ON a.id=ytd_ranks.article
+    LEFT JOIN {config.db["schema"]}.month_ranks ON a.id=month_ranks.article
+    LEFT JOIN {config.db["schema"]}.category_ranks ON a.id=category_ranks.article
+    ORDER BY a.id
+  """
+
+  compressor = zlib.compressobj(config.export["compression_level"], zlib.DEFLATED, 31) # 31: gzip format
+  buffer = io.StringIO()
+  writer = None
+  if fmt == "csv":
+    writer = csv.writer(buffer)
+    header = ["id", "doi", "title", "biorxiv_url", "repo", "category", "first_posted", "abstract",
+      "alltime_rank", "alltime_downloads", "ytd_rank", "ytd_downloads",
+      "lastmonth_rank", "lastmonth_downloads", "category_rank", "authors"]
+    if traffic:
+      header.append("traffic")
+    writer.writerow(header)
+
+  # (the cursor is held so the export's transaction doesn't stay open
+  # for as long as the client takes to read it)
+  for row in connection.stream(sql, fetch_size=config.export["fetch_size"], withhold=True):
+    authors = row[15] if row[15] is not None else []
+    posted = row[6].strftime('%Y-%m-%d') if row[6] is not None else ""
+    if fmt == "csv":
+      entry = list(row[:15])
+      entry[6] = posted
+      entry.append("; ".join(x["name"] for x in authors))
+      if traffic:
+        entry.append(json.dumps(row[16] if row[16] is not None else []))
+      writer.writerow(entry)
+    else:
+      entry = {
+        "id": row[0],
+        "doi": row[1],
+        "title": row[2],
+        "biorxiv_url": row[3],
+        "repo": row[4],
+        "category": row[5] if row[5] is not None else "unknown",
+        "first_posted": posted,
+        "abstract": row[7],
+        "ranks": {
+          "alltime": {"rank": row[8], "downloads": row[9]},
+          "ytd": {"rank": row[10], "downloads": row[11]},
+          "lastmonth": {"rank": row[12], "downloads": row[13]},
+          "category": {"rank": row[14], "downloads": row[9]}
+        },
+        "authors": authors
+      }
+      if traffic:
+        entry["traffic"] = row[16] if row[16] is not None else []
+      buffer.write(json.dumps(entry))
+      buffer.write("\n")
+
+    if buffer.tell() >= config.export["chunk_size"]:
+      chunk = compressor.compress(buffer.getvalue().encode("utf-8"))
+      buffer.seek(0)
+      buffer.truncate()
+      if len(chunk) > 0:
+        yield chunk
+  yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
 
 def author_rankings(connection, category=""):
   """Fetches a list of authors with the most cumulative downloads.
@@ -240,13 +557,12 @@ def paper_downloads(a_id, connection):
     - A list of months and the download stats for each month
 
   """
-  result = models.Article(a_id)
-  result.GetTraffic(connection)
+  data = connection.read("SELECT month, year, pdf, abstract FROM article_traffic WHERE article_traffic.article=%s ORDER BY year ASC, month ASC;", (a_id,))
   return {
     "query": {
       "id": a_id
     },
-    "results": [{"month": x.month, "year": x.year, "downloads": x.downloads, "views": x.views} for x in result.traffic]
+    "results": [{"month": x[0], "year": x[1], "downloads": x[2], "views": x[3]} for x in data]
   }
 
 def get_distribution(category, metric, connection):
@@ -277,19 +593,20 @@ def get_distribution(category, metric, connection):
 def top_year(year, connection):
   resp = connection.read("""
   SELECT SUM(t.pdf) as downloads, t.article, a.url,
-    a.title, a.abstract, a.collection, a.posted, a.doi
+    a.title, a.abstract, a.collection, a.posted, a.doi, a.repo
     FROM article_traffic t
     INNER JOIN articles a ON t.article=a.id
     WHERE t.year = %s
       AND a.posted >= '%s-01-01'
       AND a.posted <= '%s-12-31'
-    GROUP BY 2,3,4,5,6,7,8
+    GROUP BY 2,3,4,5,6,7,8,9
     ORDER BY 1 DESC
     LIMIT 25
   """, (year,year,year))
   if len(resp) == 0:
     return []
-  results = [models.SearchResultArticle(a, connection) for a in resp]
+  authors = models.get_authors_bulk([a[1] for a in resp], connection, as_json=True)
+  results = [models.SearchResultArticle(a, connection, authors[a[1]]) for a in resp]
   return results
 
 def summary_stats(connection, category=None):
@@ -308,18 +625,13 @@ def summary_stats(connection, category=None):
     'submissions': [],
     'downloads': []
   }
+  repos = ['biorxiv','medrxiv']
+  maxyear, maxmonth, submissions, downloads = _monthly_stats(repos, connection)
 
   # Submissions:
   # The reason this is so complicated is because bioRxiv has more
   # months of submissions, but we want an entry for each month.
-
-  # figure out the most recent month, so we know when to stop:
-  data = connection.read(f"SELECT MAX(EXTRACT(YEAR FROM posted)) FROM {config.db['schema']}.articles")
-  maxyear = int(data[0][0])
-  data = connection.read(f"SELECT MAX(EXTRACT(MONTH FROM posted)) FROM {config.db['schema']}.articles WHERE EXTRACT(YEAR FROM posted) = %s", (maxyear,))
-  maxmonth = int(data[0][0])
-
-  for repo in ['biorxiv','medrxiv']:
+  for repo in repos:
     repodata = {}
     for year in range(2013, maxyear + 1):
       repodata[year] = {}
@@ -329,17 +641,9 @@ def summary_stats(connection, category=None):
         if year == maxyear and month > maxmonth:
           break
         repodata[year][month] = 0
-    data = connection.read("""
-      SELECT EXTRACT(MONTH FROM posted)::int AS month,
-        EXTRACT(YEAR FROM posted)::int AS year, COUNT(id) AS submissions
-      FROM prod.articles
-      WHERE posted IS NOT NULL
-      AND repo=%s
-      GROUP BY year, month
-      ORDER BY year, month;
-    """,(repo,))
-    for entry in data:
-      repodata[entry[1]][entry[0]] = entry[2]
+    for entry in submissions:
+      if entry[0] == repo:
+        repodata[entry[2]][entry[1]] = entry[3]
 
     monthdata = []
     for year, yeardata in repodata.items():
@@ -368,7 +672,7 @@ def summary_stats(connection, category=None):
     maxmonth += 12 - adjust
     maxyear -= 1
 
-  for repo in ['biorxiv','medrxiv']:
+  for repo in repos:
     repodata = {}
     for year in range(2013, maxyear + 1):
       repodata[year] = {}
@@ -378,21 +682,15 @@ def summary_stats(connection, category=None):
         if year == maxyear and month > maxmonth:
           break
         repodata[year][month] = 0
-    data = connection.read("""
-      SELECT t.month, t.year, sum(t.pdf) AS downloads
-      FROM prod.article_traffic t
-      INNER JOIN prod.articles a ON t.article=a.id
-      WHERE repo=%s
-      GROUP BY year, month
-      ORDER BY year, month
-    """,(repo,))
-    for entry in data:
+    for entry in downloads:
+      if entry[0] != repo:
+        continue
       # skip results outside the range we want
-      if entry[1] > maxyear:
+      if entry[2] > maxyear:
         continue
-      if entry[1] == maxyear and entry[0] > maxmonth:
+      if entry[2] == maxyear and entry[1] > maxmonth:
         continue
-      repodata[entry[1]][entry[0]] = entry[2]
+      repodata[entry[2]][entry[1]] = entry[3]
 
     monthdata = []
     for year, yeardata in repodata.items():
@@ -412,96 +710,154 @@ def summary_stats(connection, category=None):
 
   return results
 
-def site_stats(connection):
-  """Returns a (very) brief summary of the information indexed by Rxivist. More of
-  a data hygiene report than anything.
+def _monthly_stats(repos, connection):
+  """Fetches the monthly submission and download totals used by
+  summary_stats(), either from the monthly_stats table (see
+  db/migrations/005_monthly_stats.sql) or, if config.monthly_stats_table
+  is False, by grouping the articles and article_traffic tables.
 
   Arguments:
+    - repos: The repositories to fetch totals for
     - connection: a database Connection object.
   Returns:
-    - A dict with the total indexed papers and authors
+    - The year and month of the most recently posted paper
+    - A list of (repo, month, year, submissions) tuples
+    - A list of (repo, month, year, downloads) tuples
 
   """
+  if config.monthly_stats_table:
+    data = connection.read("""
+      SELECT repo, month, year, submissions, downloads
+      FROM monthly_stats
+      WHERE repo=ANY(%s)
+      ORDER BY repo, year, month
+    """, (repos,))
+    submissions = [(e[0], e[1], e[2], e[3]) for e in data if e[3] > 0]
+    downloads = [(e[0], e[1], e[2], e[4]) for e in data if e[4] > 0]
+    maxyear, maxmonth = max((e[2], e[1]) for e in submissions)
+    return maxyear, maxmonth, submissions, downloads
+
+  # The most recent month, the submissions and the downloads don't
+  # depend on each other, so they're all fetched at once, each
+  # covering every repository:
+  latest, submissions, downloads = connection.concurrently(
+    lambda: connection.read(f"""
+      SELECT EXTRACT(YEAR FROM MAX(posted))::int, EXTRACT(MONTH FROM MAX(posted))::int
+      FROM {config.db['schema']}.articles
+    """),
+    lambda: connection.read("""
+      SELECT repo, EXTRACT(MONTH FROM posted)::int AS month,
+        EXTRACT(YEAR FROM posted)::int AS year, COUNT(id) AS submissions
+      FROM prod.articles
+      WHERE posted IS NOT NULL
+      AND repo=ANY(%s)
+      GROUP BY repo, year, month
+      ORDER BY repo, year, month;
+    """,(repos,)),
+    lambda: connection.read("""
+      SELECT a.repo, t.month, t.year, sum(t.pdf) AS downloads
+      FROM prod.article_traffic t
+      INNER JOIN prod.articles a ON t.article=a.id
+      WHERE a.repo=ANY(%s)
+      GROUP BY a.repo, t.year, t.month
+      ORDER BY a.repo, t.year, t.month
+    """,(repos,))
+  )
+  maxyear, maxmonth = latest[0]
+  return maxyear, maxmonth, submissions, downloads
 
-  # Counting up how many of each entity we have
-  resp = connection.read("SELECT COUNT(id) FROM articles;")
-  if len(resp) != 1 or len(resp[0]) != 1:
-    paper_count = 0
-  else:
-    paper_count = resp[0][0]
+def site_stats(connection):
+  """Returns a (very) brief summary of the information indexed by Rxivist. More of
+  a data hygiene report than anything.
 
-  resp = connection.read("SELECT COUNT(id) FROM authors;")
-  if len(resp) != 1 or len(resp[0]) != 1:
-    author_count = 0
-  else:
-    author_count = resp[0][0]
+  The article-level tallies are collected in a single pass over the
+  articles table, and the remaining queries are sent at the same time,
+  so the response takes about as long as the slowest of them.
 
-  resp = connection.read("SELECT COUNT(id) FROM articles WHERE abstract IS NULL;")
-  if len(resp) != 1 or len(resp[0]) != 1:
-    no_abstract = 0
-  else:
-    no_abstract = resp[0][0]
+  Arguments:
+    - connection: a database Connection object.
+  Returns:
+    - A dict with the total indexed papers and authors
 
-  resp = connection.read("SELECT COUNT(id) FROM articles WHERE posted IS NULL;")
-  if len(resp) != 1 or len(resp[0]) != 1:
-    no_posted = 0
+  """
+  articles, authors, outdated_resp, no_authors, no_papers = connection.concurrently(
+    # Counting up how many of each entity we have
+    lambda: connection.read("""
+      SELECT COUNT(id),
+        COUNT(id) FILTER (WHERE abstract IS NULL),
+        COUNT(id) FILTER (WHERE posted IS NULL),
+        COUNT(id) FILTER (WHERE collection IS NULL)
+      FROM articles;
+    """),
+    lambda: connection.read("SELECT COUNT(id) FROM authors;"),
+    lambda: connection.read("SELECT collection, COUNT(id) FROM articles WHERE last_crawled < now() - interval %s GROUP BY collection ORDER BY collection;", (config.outdated_limit,)),
+    lambda: connection.read(f"""
+      SELECT COUNT(a.id)
+      FROM {config.db["schema"]}.articles a
+      WHERE NOT EXISTS (
+        SELECT 1 FROM {config.db["schema"]}.article_authors w WHERE w.article=a.id
+      );
+    """),
+    lambda: connection.read(f"""
+      SELECT COUNT(a.id)
+      FROM {config.db["schema"]}.authors a
+      WHERE NOT EXISTS (
+        SELECT 1 FROM {config.db["schema"]}.article_authors z WHERE z.author=a.id
+      );
+    """)
+  )
+
+  if len(articles) != 1 or len(articles[0]) != 4:
+    paper_count, no_abstract, no_posted, no_category = 0, 0, 0, 0
   else:
-    no_posted = resp[0][0]
+    paper_count, no_abstract, no_posted, no_category = articles[0]
 
   outdated = {}
-  resp = connection.read("SELECT collection, COUNT(id) FROM articles WHERE last_crawled < now() - interval %s GROUP BY collection ORDER BY collection;", (config.outdated_limit,))
-  if len(resp) > 0:
-    for entry in resp:
-      if len(entry) < 2:
-        continue # something fishy with this entry
-      outdated[entry[0]] = entry[1]
-
-  resp = connection.read("SELECT COUNT(id) FROM articles WHERE collection IS NULL;")
-  if len(resp) != 1 or len(resp[0]) != 1:
-    no_category = 0
-  else:
-    no_category = resp[0][0]
-
-  resp = connection.read(f"""
-  SELECT COUNT(id)
-  FROM (
-    SELECT
-      a.id, COUNT(w.author) AS authors
-    FROM {config.db["schema"]}.articles a
-    LEFT JOIN {config.db["schema"]}.article_authors w ON w.article=a.id
-    GROUP BY a.id
-    ORDER BY authors
-  ) AS authorcount
-  WHERE authors=0;
-  """)
-  if len(resp) != 1 or len(resp[0]) != 1:
-    no_authors = 0
-  else:
-    no_authors = resp[0][0]
-
-  resp = connection.read(f"""
-  SELECT COUNT(id)
-  FROM (
-    SELECT a.id, COUNT(z.article) AS num
-    FROM prod.authors a
-    LEFT JOIN prod.article_authors z ON a.id=z.author
-    GROUP BY 1
-    ORDER BY 2 DESC
-  ) AS asdf
-  WHERE num = 0
-  """)
-  if len(resp) != 1 or len(resp[0]) != 1:
-    no_papers = 0
-  else:
-    no_papers = resp[0][0]
+  for entry in outdated_resp:
+    if len(entry) < 2:
+      continue # something fishy with this entry
+    outdated[entry[0]] = entry[1]
 
   return {
     "papers_indexed": paper_count,
-    "authors_indexed": author_count,
+    "authors_indexed": _single_count(authors),
     "missing_abstract": no_abstract,
     "missing_date": no_posted,
     "outdated_count": outdated,
-    "missing_authors": no_authors,
+    "missing_authors": _single_count(no_authors),
     "missing_category": no_category,
-    "authors_no_papers": no_papers
-  }
\ No newline at end of file
+    "authors_no_papers": _single_count(no_papers)
+  }
+
+def rank_builds(connection):
+  """Reports on the most recent rebuild of each ranking table, as recorded
+  by the spider in the rank_builds table (see db/migrations/007_rank_builds.sql).
+
+  Arguments:
+    - connection: a database Connection object.
+  Returns:
+    - A dict with an entry for each ranking table, indicating when it was
+        last swapped in, how many seconds the build took and how many rows it has.
+
+  """
+  resp = connection.read("""
+    SELECT DISTINCT ON (rank_table) rank_table, finished,
+      EXTRACT(EPOCH FROM finished - started), row_count
+    FROM rank_builds
+    WHERE finished IS NOT NULL
+    ORDER BY rank_table, finished DESC
+  """)
+  return {
+    entry[0]: {
+      "finished": entry[1].isoformat(),
+      "seconds": round(float(entry[2]), 3),
+      "rows": entry[3]
+    } for entry in resp
+  }
+
+def _single_count(resp):
+  """Pulls the number out of the results of a query that selects a single
+  COUNT(), or returns 0 if the results don't look like that."""
+  if len(resp) != 1 or len(resp[0]) != 1:
+    return 0
+  return resp[0][0]
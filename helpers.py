@@ -2,6 +2,17 @@
 
 This module stores helper functions that transform data for the controllers.
 """
+import base64
+import decimal
+import json
+import math
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+import config
 
 class NotFoundError(Exception):
   """
@@ -17,11 +28,50 @@ class NotFoundError(Exception):
     """
     self.message = f"Entity could not be found with id {id}"
 
+class BusyError(Exception):
+  """
+  Helper exception for when a request can't be served until some of
+  the others like it have finished; we should be returning 503s.
+
+  """
+  def __init__(self, message):
+    """Sets the exception message.
+
+    Arguments:
+      - message: What the server is too busy to do.
+
+    """
+    self.message = message
+
+def _json_default(value):
+  """Converts values that the JSON libraries can't serialize on their own
+  (such as the Decimals Postgres returns for SUM()s)."""
+  if isinstance(value, decimal.Decimal):
+    return int(value) if value == value.to_integral_value() else float(value)
+  raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def json_dumps(value):
+  """Serializes a response with the JSON library named in
+  config.json_encoder, falling back to the standard library's if that
+  one isn't installed. Whichever is used, the decoded output is the same:
+  non-string keys (like the None that stands for a missing collection)
+  are written the way the standard library writes them.
+
+  Arguments:
+    - value: The dict (or other JSON-compatible value) to serialize
+
+  Returns:
+    - The UTF-8 encoded JSON
+
+  """
+  if config.json_encoder == "orjson" and orjson is not None:
+    return orjson.dumps(value, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+  return json.dumps(value, default=_json_default).encode("utf-8")
+
 def doi_to_id(doi, connection):
   """If a request comes in for an author of an ID that indicates
   it's part of the old numbering scheme, this will check to see if
   we have an updated number to redirect to."""
-  print(f"LOOKIN FOR {doi}")
   result = connection.read("SELECT id FROM articles WHERE doi=%s", (doi,))
   if len(result) == 0:
     return False
@@ -58,3 +108,66 @@ def num_to_month(monthnum):
   if monthnum is None or monthnum < 1 or monthnum > 12:
     return ""
   return months[monthnum]
+
+def encode_cursor(metric, timeframe, sort, values):
+  """Builds the opaque string handed to API users that points to the
+  position in a list of search results after which the next page begins.
+
+  Arguments:
+    - metric: The metric used to rank the results
+    - timeframe: The timeframe used to rank the results
+    - sort: Whether the results are ordered by the metric or by relevance
+    - values: The sort key of the last result on the current page, such as
+        its rank and ID
+
+  Returns:
+    - A URL-safe string encoding all of the above
+
+  """
+  raw = json.dumps([metric, timeframe, sort, values], separators=(',', ':'))
+  return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+  """Unpacks a cursor created by encode_cursor().
+
+  Arguments:
+    - cursor: The string submitted by the API user
+
+  Returns:
+    - The metric, timeframe, sort order and list of sort key values
+        stored in the cursor
+
+  Raises:
+    - ValueError: if the cursor couldn't have been created by encode_cursor()
+
+  """
+  try:
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    metric, timeframe, sort, values = json.loads(raw)
+  except Exception:
+    raise ValueError(f"{cursor} is not a valid cursor.")
+  if not all(isinstance(x, str) for x in [metric, timeframe, sort]) or not isinstance(values, list):
+    raise ValueError(f"{cursor} is not a valid cursor.")
+  # the values are sent to the database as they are, so anything but
+  # what encode_cursor() stores is rejected here: a paper ID, after
+  # either a rank or metric (both integers) or a relevance score
+  if len(values) != 2 or not _is_integer(values[1]):
+    raise ValueError(f"{cursor} is not a valid cursor.")
+  if sort == "relevance":
+    if not _is_number(values[0]):
+      raise ValueError(f"{cursor} is not a valid cursor.")
+  elif not _is_integer(values[0]):
+    raise ValueError(f"{cursor} is not a valid cursor.")
+  return metric, timeframe, sort, values
+
+def _is_number(value):
+  """Determines whether a decoded JSON value is a finite number (and not
+  a boolean, which Python also treats as an int)."""
+  if isinstance(value, bool) or not isinstance(value, (int, float)):
+    return False
+  return math.isfinite(value)
+
+def _is_integer(value):
+  """Determines whether a decoded JSON value is an integer (and not a
+  boolean)."""
+  return isinstance(value, int) and not isinstance(value, bool)
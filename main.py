@@ -27,22 +27,82 @@
 This is the entrypoint for the application, the script called
 when the server is started and the router for all user requests.
 """
+import functools
 import re
+import sys
 
 import bottle
 
+import cache
+import compression
 import config
 import db
 import endpoints
 import helpers
 import models
+import profiling
 
 connection = db.Connection(config.db["host"], config.db["db"], config.db["user"], config.db["password"])
 
+# Encode responses with the JSON library chosen in config.json_encoder,
+# add the query breakdown for requests that asked for it, then compress
+# them. (Plugins installed later run first, so JSON encoding is
+# installed last.)
+bottle.uninstall(bottle.JSONPlugin)
+bottle.install(compression.plugin)
+bottle.install(functools.partial(profiling.plugin, connection=connection))
+bottle.install(bottle.JSONPlugin(json_dumps=helpers.json_dumps))
+
+# - HOOKS -
+
+@bottle.hook('before_request')
+def checkout_connection():
+  connection.begin_request()
+  cache.data_version.check(connection)
+  cache.note_version()
+
+@bottle.hook('before_request')
+def check_etag():
+  if not config.etag["enabled"] or bottle.request.method not in ["GET", "HEAD"]:
+    return
+  # The response would be sent with the encoding negotiated here, unless
+  # it's too small to be worth compressing, so the client could have
+  # either version. (set_etag() builds the tag the same way, from the
+  # encoding that was actually used.)
+  encoding = compression.negotiate()
+  etag = cache.etag_matches([cache.etag(encoding), cache.etag()])
+  cache_control = cache.cache_controls.get(cache.request_key())
+  if etag is None or cache_control is None:
+    return
+  headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+  if cache_control != "":
+    headers["Cache-Control"] = cache_control
+  raise bottle.HTTPResponse(status=304, headers=headers)
+
+@bottle.hook('after_request')
+def release_connection():
+  profiling.report(connection.end_request())
+
+@bottle.hook('after_request')
+def set_etag():
+  if not config.etag["enabled"] or bottle.response.status_code != 200:
+    return
+  # After_request hooks run even when the response is replaced by an
+  # exception, such as the 304 raised by check_etag(), an unknown path or
+  # an error in the route; bottle.response doesn't describe what's sent
+  # in that case, so it gets no ETag
+  if sys.exc_info()[0] is not None:
+    return
+  etag = cache.etag(bottle.response.get_header("Content-Encoding"))
+  if etag is not None:
+    bottle.response.set_header("ETag", etag)
+    cache.cache_controls.put(cache.request_key(), bottle.response.get_header("Cache-Control", ""))
+
 # - ROUTES -
 
 #  paper query endpoint
 @bottle.get('/v<version:int>/papers')
+@cache.cached("front_page", lambda: bottle.request.query_string == "")
 def index(version):
   query = bottle.request.query.q
   timeframe = bottle.request.query.timeframe
@@ -52,6 +112,8 @@ def index(version):
   page = bottle.request.query.page
   page_size = bottle.request.query.page_size
   repo = bottle.request.query.repo
+  cursor = bottle.request.query.cursor
+  sort = bottle.request.query.sort
   error = ""
 
   default_front = (metric == '' and timeframe == '')
@@ -62,6 +124,23 @@ def index(version):
     bottle.response.status = 400
     return {"error": error}
 
+  # A cursor points into the results of a specific ranking, so if
+  # one was sent without a metric, use the one it was created with
+  if cursor == "":
+    cursor = None
+  else:
+    try:
+      cursor_metric, cursor_timeframe, cursor_sort, cursor = helpers.decode_cursor(cursor)
+    except ValueError as e:
+      bottle.response.status = 400
+      return {"error": f"There was a problem with the submitted query: {e}"}
+    if default_front:
+      metric = cursor_metric
+      timeframe = cursor_timeframe
+      default_front = False
+    if sort == "":
+      sort = cursor_sort
+
   if metric not in ["downloads", "twitter"]:
     metric = "twitter"
   if metric == "twitter":
@@ -79,6 +158,24 @@ def index(version):
       bottle.response.status = 400
       return {"error": error}
 
+  # Results can be ordered by their relevance to a text search
+  # rather than by the metric:
+  if sort == "":
+    sort = "metric"
+  if sort not in ["metric", "relevance"]:
+    error = f"There was a problem with the submitted query: {sort} is not a recognized sort order."
+    bottle.response.status = 400
+    return {"error": error}
+  if sort == "relevance" and query == "":
+    error = "There was a problem with the submitted query: results can only be sorted by relevance to a text search."
+    bottle.response.status = 400
+    return {"error": error}
+
+  if cursor is not None and (metric != cursor_metric or timeframe != cursor_timeframe or sort != cursor_sort or len(cursor) != 2):
+    error = f"There was a problem with the submitted query: the specified cursor is not valid for {metric} rankings over timeframe {timeframe}."
+    bottle.response.status = 400
+    return {"error": error}
+
   # The v1 API defaults to returning ONLY biorxiv, but v2 returns
   # everything we have
   if repo == "":
@@ -91,14 +188,13 @@ def index(version):
     bottle.response.status = 400
     return {"error": error}
 
-  category_list = endpoints.get_categories(connection,repo) # list of all article categories
   # Get rid of a category filter that's just one empty parameter:
   if len(category_filter) == 1 and category_filter[0] == "":
     category_filter = []
   else:
     # otherwise validate that the categories are valid
     for cat in category_filter:
-      if cat not in category_list:
+      if not endpoints.is_category(cat, connection, repo):
         error = f"There was a problem with the submitted query: {cat} is not a recognized category for the specified repositories."
         bottle.response.status = 400
         return {"error": error}
@@ -131,34 +227,20 @@ def index(version):
 
   results = {} # a list of articles for the current page
   totalcount = 0 # how many results there are in total
+  next_cursor = None # where the next page of results begins
+  count_type = "exact" # how totalcount was determined
 
   if error == "": # if nothing's gone wrong yet, fetch results:
     try:
-      results, totalcount = endpoints.paper_query(query, category_filter, timeframe, metric, page, page_size, repo, version, connection)
+      # If daily twitter stats aren't available go weekly, and if there
+      # are too few of those, roll over to downloads instead:
+      if default_front:
+        metric, timeframe = endpoints.front_page_ranking(query, category_filter, repo, version, connection)
+      results, totalcount, count_type, next_cursor = endpoints.paper_query(query, category_filter, timeframe, metric, page, page_size, repo, version, connection, cursor, sort)
     except Exception as e:
       error = f"There was a problem with the submitted query: {e}"
       bottle.response.status = 500
       return {"error": error}
-  # If daily twitter stats aren't available go weekly:
-  if default_front:
-    if totalcount < config.min_daily_twitter:
-      timeframe = 'week'
-      try:
-        results, totalcount = endpoints.paper_query(query, category_filter, timeframe, metric, page, page_size, repo, version, connection)
-      except Exception as e:
-        error = f"There was a problem with the submitted query: {e}"
-        bottle.response.status = 500
-        return {"error": error}
-      # If there is an unreasonably low number of weekly results, just roll over to downloads instead
-      if totalcount < config.min_weekly_twitter:
-        metric = 'downloads'
-        timeframe = 'lastmonth'
-        try:
-          results, totalcount = endpoints.paper_query(query, category_filter, timeframe, metric, page, page_size, repo, version, connection)
-        except Exception as e:
-          error = f"There was a problem with the submitted query: {e}"
-          bottle.response.status = 500
-          return {"error": error}
 
   # CACHE CONTROL
   # website front page
@@ -168,8 +250,11 @@ def index(version):
   if query == "" and page < 3 and page_size == config.default_page_size:
     bottle.response.set_header("Cache-Control", f'max-age={config.cache["simple"]}, stale-while-revalidate=172800')
 
-  resp = models.PaperQueryResponse(results, query, timeframe, category_filter, metric, page, page_size, totalcount, repo)
-  return resp.json()
+  if next_cursor is not None:
+    next_cursor = helpers.encode_cursor(metric, timeframe, sort, next_cursor)
+  resp = models.PaperQueryResponse(results, query, timeframe, category_filter, metric, page, page_size, totalcount, repo, next_cursor, count_type, sort)
+  bottle.response.content_type = "application/json"
+  return resp.serialize()
 
 # paper details
 @bottle.get('/v1/papers/<id:path>')
@@ -178,11 +263,8 @@ def paper_details(id):
   try:
     article_id = int(id)
   except Exception:
-    print("\n\n\nNOT AN INT")
     new_id = helpers.doi_to_id(id, connection)
-    print(f'New ID is {new_id}')
     if new_id:
-      print(f"{config.host}/v1/papers/{new_id}")
       return bottle.redirect(f"{config.host}/v1/papers/{new_id}", 301)
     else:
       bottle.response.status = 404
@@ -196,6 +278,8 @@ def paper_details(id):
     bottle.response.status = 500
     return {"error": f"Server error – {e}"}
   bottle.response.set_header("Cache-Control", f'max-age={config.cache["paper"]}, stale-while-revalidate=172800')
+  if paper.last_crawled is not None:
+    bottle.response.set_header("Last-Modified", bottle.http_date(paper.last_crawled))
   return paper.json()
 
 # paper download stats
@@ -236,13 +320,43 @@ def display_author_details(author_id):
   return author.json()
 
 @bottle.get('/v1/top/<year:int>')
+@cache.cached("top")
 def alltime_author_ranks(year):
   resp = endpoints.top_year(year, connection)
-  bottle.response.set_header("Cache-Control", f'max-age=15552000, stale-while-revalidate=15552000')
+  bottle.response.set_header("Cache-Control", f'max-age={config.cache["top"]}, stale-while-revalidate=15552000')
   return {
     "results": [x.json() for x in resp]
   }
 
+# bulk export endpoint
+@bottle.get('/v1/export/papers')
+def export_papers():
+  if not config.export["enabled"]:
+    bottle.response.status = 404
+    return {"error": "Bulk exports are not available."}
+  fmt = bottle.request.query.format
+  if fmt == "":
+    fmt = "ndjson"
+  if fmt not in ["ndjson", "csv"]:
+    bottle.response.status = 400
+    return {"error": f"There was a problem with the submitted query: {fmt} is not a recognized format. Expected 'ndjson' or 'csv'."}
+  traffic = bottle.request.query.traffic
+  if traffic not in ["", "true", "false"]:
+    bottle.response.status = 400
+    return {"error": f"There was a problem with the submitted query: expected 'true' or 'false' for traffic; got '{traffic}'"}
+  traffic = traffic == "true"
+
+  try:
+    export = endpoints.export_papers(fmt, traffic, connection)
+  except helpers.BusyError as e:
+    bottle.response.status = 503
+    bottle.response.set_header("Retry-After", str(config.export["retry_after"]))
+    return {"error": f"{e.message} Try again later."}
+  bottle.response.content_type = "application/gzip"
+  bottle.response.set_header("Content-Disposition", f'attachment; filename="rxivist_papers.{fmt}.gz"')
+  bottle.response.set_header("Cache-Control", f'max-age={config.cache["simple"]}')
+  return export
+
 # categories list endpoint
 @bottle.get('/v1/data/categories')
 def get_category_list():
@@ -257,6 +371,7 @@ def get_category_list():
 
 # stat distributions endpoint
 @bottle.get('/v1/data/distributions/<entity>/<metric>')
+@cache.cached("distributions")
 def get_distros(entity, metric):
   if entity not in ["paper", "author"]:
     bottle.response.status = 404
@@ -285,6 +400,7 @@ def get_counts():
 
 # site summary stats
 @bottle.get('/v1/data/summary')
+@cache.cached("summary")
 def summary_stats():
   try:
     details = endpoints.summary_stats(connection)
@@ -294,9 +410,26 @@ def summary_stats():
   except ValueError as e:
     bottle.response.status = 500
     return {"error": f"Server error – {e}"}
-  bottle.response.set_header("Cache-Control", f'max-age=1200, stale-while-revalidate=172800')
+  bottle.response.set_header("Cache-Control", f'max-age={config.cache["summary"]}, stale-while-revalidate=172800')
   return details
 
+# server health endpoint
+@bottle.get('/v1/data/server')
+def server_stats():
+  # (this reports the server's internals, so it's only there for
+  # requests that know the debug parameter; see config.profiling)
+  if not profiling.debug_requested("server"):
+    bottle.abort(404)
+  try:
+    builds = endpoints.rank_builds(connection)
+  except Exception as e:
+    builds = {"error": f"Server error – {e}"}
+  return {
+    "pool": connection.stats(),
+    "cache": cache.responses.stats(),
+    "rank_builds": builds
+  }
+
 # ---- Errors
 @bottle.error(404)
 def error404(error):
@@ -305,6 +438,6 @@ def error404(error):
 
 # - SERVER -
 if config.use_prod_webserver:
-  bottle.run(host='0.0.0.0', port=80, server="gunicorn")
+  bottle.run(host='0.0.0.0', port=80, server="gunicorn", **config.gunicorn)
 else:
   bottle.run(host='0.0.0.0', port=80, debug=True, reloader=True)
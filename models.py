@@ -6,6 +6,7 @@ additional information.
 """
 import math
 
+import cache
 import config
 import db
 import helpers
@@ -18,7 +19,7 @@ class PaperQueryResponse(object):
   that way users will have a way of finding out if they've bumped against a limit.
 
   """
-  def __init__(self, results, query, timeframe, category_filter, metric, current_page, page_size, totalcount, repo):
+  def __init__(self, results, query, timeframe, category_filter, metric, current_page, page_size, totalcount, repo, next_cursor=None, count_type="exact", sort="metric"):
     """The initialization method takes all the required information and stores it in
     memory; nothing except the final page number is calculated here.
 
@@ -36,6 +37,14 @@ class PaperQueryResponse(object):
       - page_size: How many results to return at one time.
       - totalcount: How many results there are on all pages combined.
       - repo: Which preprint repository was specified in request
+      - next_cursor: An opaque string that can be sent as the "cursor"
+          parameter to get the page after this one, or None if this is
+          the last page.
+      - count_type: How totalcount was determined: "exact", "cached" (counted
+          exactly during an earlier request) or "estimated" (guessed by the
+          database's query planner).
+      - sort: Whether the results are ordered by the metric ("metric") or by
+          relevance to the text search ("relevance").
 
     """
     self.results = results
@@ -48,28 +57,51 @@ class PaperQueryResponse(object):
     self.final_page = math.ceil(totalcount / page_size) - 1 # zero-indexed
     self.totalcount = totalcount
     self.repo = repo
+    self.next_cursor = next_cursor
+    self.count_type = count_type
+    self.sort = sort
+
+  def _query(self):
+    """Returns a dict of the query parameters, as included in the response."""
+    return {
+      "text_search": self.query,
+      "timeframe": self.timeframe,
+      "categories": self.category_filter,
+      "metric": self.metric,
+      "sort": self.sort,
+      "page_size": self.page_size,
+      "current_page": self.current_page,
+      "final_page": self.final_page,
+      "total_results": self.totalcount,
+      "total_results_type": self.count_type,
+      "repository": self.repo,
+      "next_cursor": self.next_cursor
+    }
 
   def json(self):
     """Turns the PaperQueryResponse object into a dict that can be more
     easily serialized into JSON."""
     return {
-      "query": {
-        "text_search": self.query,
-        "timeframe": self.timeframe,
-        "categories": self.category_filter,
-        "metric": self.metric,
-        "page_size": self.page_size,
-        "current_page": self.current_page,
-        "final_page": self.final_page,
-        "total_results": self.totalcount,
-        "repository": self.repo
-      },
+      "query": self._query(),
       "results": [r.json() for r in self.results]
     }
 
+  def serialize(self):
+    """Serializes the response straight to JSON, assembling the results
+    from each article's cached fragment rather than building a dict for
+    every one of them.
+
+    Returns:
+      - The same JSON document json() describes, UTF-8 encoded
+    """
+    results = b",".join(r.serialize() for r in self.results)
+    return b'{"query":' + helpers.json_dumps(self._query()) + b',"results":[' + results + b']}'
+
 class Author:
   """Stores information about an individual person associated with
   one or more papers."""
+  __slots__ = ("id", "name", "institution", "orcid", "articles", "ranks", "has_full_info", "has_basic_info")
+
   def __init__(self, author_id, name=""):
     """Because the Author class is used in several different areas
     that have different requirements for how detailed the info needs
@@ -111,9 +143,12 @@ class Author:
       - self.has_full_info: A boolean indicating all of these values have been fetched.
 
     """
-    self.name, self.institution, self.orcid = self._find_vitals(connection)
-    self.articles = self._find_articles(connection)
-    self.ranks = self._find_ranks(connection)
+    vitals, self.articles, self.ranks = connection.concurrently(
+      lambda: self._find_vitals(connection),
+      lambda: self._find_articles(connection),
+      lambda: self._find_ranks(connection)
+    )
+    self.name, self.institution, self.orcid = vitals
     self.has_full_info = True
 
   def GetBasicInfo(self, connection):
@@ -129,7 +164,26 @@ class Author:
       - self.has_basic_info: A boolean indicating all of these values have been fetched.
 
     """
-    self.name, self.institution, self.orcid = self._find_vitals(connection)
+    self.SetBasicInfo(*self._find_vitals(connection))
+
+  def SetBasicInfo(self, name, institution, orcid):
+    """Records the author's basic info when it has already been fetched
+    elsewhere, such as alongside the rest of a paper's author list.
+
+    Arguments:
+      - name: The author's name
+      - institution: One of the author's institutional affiliations
+      - orcid: The ORCID universal identifier specified by the author
+
+    Side effects:
+      - self.name, self.institution, self.orcid: Set from the arguments, with
+          empty strings recorded as None.
+      - self.has_basic_info: A boolean indicating all of these values have been fetched.
+
+    """
+    self.name = name
+    self.institution = institution if institution != "" else None
+    self.orcid = orcid if orcid != "" else None
     self.has_basic_info = True
 
   def json(self):
@@ -194,15 +248,16 @@ class Author:
       - A list of AuthorArticle objects with basic info and rankings for each paper
 
     """
-    sql = """
-      SELECT articles.id
+    sql = f"""
+      SELECT articles.id, articles.url, articles.title, articles.collection,
+        articles.posted, articles.doi, {ArticleRanks.columns}
       FROM articles
-      LEFT JOIN article_authors ON articles.id=article_authors.article
-      LEFT JOIN alltime_ranks ON articles.id=alltime_ranks.article
+      INNER JOIN article_authors ON articles.id=article_authors.article
+      {ArticleRanks.joins}
       WHERE article_authors.author=%s ORDER BY alltime_ranks.downloads DESC
     """
     articles = connection.read(sql, (self.id,))
-    articles = [AuthorArticle(a[0], connection) for a in articles]
+    articles = [AuthorArticle(a[0], connection, a[1:]) for a in articles]
     return articles
 
   def _find_emails(self, connection):
@@ -246,6 +301,8 @@ class Author:
 
 class DateEntry(object):
   "Stores paper publication date info."
+  __slots__ = ("month", "year", "monthname")
+
   def __init__(self, month, year):
     self.month = month
     self.year = year
@@ -254,6 +311,8 @@ class DateEntry(object):
 class ArticleRankEntry(object):
   """Stores data about a paper's rank within a
   single corpus."""
+  __slots__ = ("downloads", "rank", "tie")
+
   def __init__(self, rank=0, tie=False, downloads=0):
     self.downloads = downloads
     self.rank = rank
@@ -269,6 +328,8 @@ class ArticleRankEntry(object):
 class AuthorRankEntry(object):
   """Stores data about an author's rank within a
   single corpus."""
+  __slots__ = ("downloads", "rank", "tie", "category")
+
   def __init__(self, rank=0, tie=False, downloads=0, category=""):
     self.downloads = downloads
     self.rank = rank
@@ -290,26 +351,37 @@ class ArticleRanks(object):
   the same category.
 
   """
-  def __init__(self, article_id, connection):
+  __slots__ = ("alltime", "ytd", "lastmonth", "collection")
+
+  # The columns (and joins) needed to build an ArticleRanks object; other
+  # queries can include these to fetch an article's ranks alongside its
+  # other details.
+  columns = """alltime_ranks.rank, ytd_ranks.rank,
+        month_ranks.rank, category_ranks.rank, articles.collection,
+        alltime_ranks.downloads, ytd_ranks.downloads, month_ranks.downloads"""
+  joins = """LEFT JOIN alltime_ranks ON articles.id=alltime_ranks.article
+      LEFT JOIN ytd_ranks ON articles.id=ytd_ranks.article
+      LEFT JOIN month_ranks ON articles.id=month_ranks.article
+      LEFT JOIN category_ranks ON articles.id=category_ranks.article"""
+
+  def __init__(self, article_id, connection, sql_entry=None):
     """Retrieves all required ranking information for a single article.
 
     Arguments:
       - article_id: The Rxivist ID of the article in question
       - connection: A database Connection object
+      - sql_entry: (Optionally) the values of ArticleRanks.columns for this
+          article, if they were already fetched with another query.
 
     """
-    sql = """
-      SELECT alltime_ranks.rank, ytd_ranks.rank,
-        month_ranks.rank, category_ranks.rank, articles.collection,
-        alltime_ranks.downloads, ytd_ranks.downloads, month_ranks.downloads
-      FROM articles
-      LEFT JOIN alltime_ranks ON articles.id=alltime_ranks.article
-      LEFT JOIN ytd_ranks ON articles.id=ytd_ranks.article
-      LEFT JOIN month_ranks ON articles.id=month_ranks.article
-      LEFT JOIN category_ranks ON articles.id=category_ranks.article
-      WHERE articles.id=%s
-    """
-    sql_entry = connection.read(sql, (article_id,))[0]
+    if sql_entry is None:
+      sql = f"""
+        SELECT {ArticleRanks.columns}
+        FROM articles
+        {ArticleRanks.joins}
+        WHERE articles.id=%s
+      """
+      sql_entry = connection.read(sql, (article_id,))[0]
 
     self.alltime = ArticleRankEntry(sql_entry[0], False, sql_entry[5])
     self.ytd = ArticleRankEntry(sql_entry[1], False, sql_entry[6])
@@ -329,46 +401,73 @@ class Article:
   are presented throughout the site.
 
   """
+  __slots__ = ("id", "authors")
+
   def __init__(self, a_id=None):
     self.id = a_id
     pass
 
-  def get_authors(self, connection):
+  def get_authors(self, connection, basic_info=False):
     """Fetches information about the paper's authors.
 
     Arguments:
       - connection: a database connection object.
+      - basic_info: Whether to also fetch each author's institution and ORCID.
 
     Side effects:
       - self.authors: A list of Author objects associated with the article
 
     """
-    self.authors = []
-    author_data = connection.read("SELECT authors.id, authors.name FROM article_authors as aa INNER JOIN authors ON authors.id=aa.author WHERE aa.article=%s ORDER BY aa.id;", (self.id,))
-    if len(author_data) > 0:
-      self.authors = [Author(a[0], a[1]) for a in author_data]
-
-  def GetTraffic(self, connection):
-    data = connection.read("SELECT month, year, pdf, abstract FROM article_traffic WHERE article_traffic.article=%s ORDER BY year ASC, month ASC;", (self.id,))
-    self.traffic = [TrafficEntry(entry) for entry in data]
-
-class TrafficEntry(object):
-  "Stores the bioRxiv traffic information for a single month"
-  def __init__(self, sql_entry):
-    self.month = sql_entry[0]
-    self.year = sql_entry[1]
-    self.downloads = sql_entry[2]
-    self.views = sql_entry[3]
+    self.authors = get_authors_bulk([self.id], connection, basic_info)[self.id]
+
+def get_authors_bulk(article_ids, connection, basic_info=False, as_json=False):
+  """Fetches the author lists for many articles at once, so building a page
+  of search results doesn't require a separate query for every paper.
+
+  Arguments:
+    - article_ids: A list of Rxivist article IDs
+    - connection: a database connection object.
+    - basic_info: Whether to also fetch each author's institution and ORCID,
+        as Author.GetBasicInfo() would.
+    - as_json: Whether to skip building Author objects and instead return
+        the dicts their json() method would produce, which is much cheaper
+        when the authors are only going to be serialized.
+
+  Returns:
+    - A dict mapping each requested article ID to a list of Author objects
+        (or dicts), in the same order they're listed on the paper. Articles
+        without any recorded authors map to an empty list.
+
+  """
+  authors = {a_id: [] for a_id in article_ids}
+  if len(article_ids) == 0:
+    return authors
+  author_data = connection.read("SELECT aa.article, authors.id, authors.name, authors.institution, authors.orcid FROM article_authors as aa INNER JOIN authors ON authors.id=aa.author WHERE aa.article=ANY(%s) ORDER BY aa.article, aa.id;", (list(authors.keys()),))
+  if as_json and not basic_info:
+    for entry in author_data:
+      authors[entry[0]].append({"id": entry[1], "name": entry[2]})
+    return authors
+  for entry in author_data:
+    author = Author(entry[1], entry[2])
+    if basic_info:
+      author.SetBasicInfo(entry[2], entry[3], entry[4])
+    authors[entry[0]].append(author.json() if as_json else author)
+  return authors
 
 class SearchResultArticle(Article):
   "An article as displayed on the main results page."
-  def __init__(self, sql_entry, connection):
+  __slots__ = ("downloads", "url", "title", "abstract", "collection", "posted", "doi", "repo")
+
+  def __init__(self, sql_entry, connection, authors=None):
     """Organizes all the known information about a single article.
 
     Arguments:
       - sql_entry: The results of the large query built up in the
           endpoints.paper_query() function.
       - connection: A database Connection object.
+      - authors: (Optionally) the article's authors, as already fetched by
+          get_authors_bulk() with as_json=True. If this is left out, the
+          authors are fetched with their own query.
 
     """
     self.downloads = sql_entry[0] # NOTE: This can be "downloads" OR "tweet count"
@@ -380,11 +479,30 @@ class SearchResultArticle(Article):
     self.posted = sql_entry[6]
     self.doi = sql_entry[7]
     self.repo = sql_entry[8]
-    self.get_authors(connection)
+    if authors is None:
+      authors = get_authors_bulk([self.id], connection, as_json=True)[self.id]
+    self.authors = authors
 
     if self.collection is None:
       self.collection = "unknown"
 
+  def serialize(self):
+    """Serializes the article to JSON. Everything but the ID and metric
+    is the same in every search that includes the article, so that part
+    is serialized once and kept in cache.fragments until the data version
+    changes.
+
+    Returns:
+      - The same JSON object json() describes, UTF-8 encoded
+    """
+    fragment = cache.fragments.get(self.id)
+    if fragment is None:
+      entry = self.json()
+      del entry["id"], entry["metric"]
+      fragment = helpers.json_dumps(entry)[1:] # without the opening brace
+      cache.fragments.put(self.id, fragment)
+    return b'{"id":' + helpers.json_dumps(self.id) + b',"metric":' + helpers.json_dumps(self.downloads) + b',' + fragment
+
   def json(self):
     return {
       "id": self.id,
@@ -396,12 +514,14 @@ class SearchResultArticle(Article):
       "category": self.collection,
       "first_posted": self.posted.strftime('%Y-%m-%d') if self.posted is not None else "",
       "abstract": self.abstract,
-      "authors": [x.json() for x in self.authors],
+      "authors": self.authors,
       "repo": self.repo
     }
 
 class SearchResultAuthor(object):
   "An author, as returned by the author rankings endpoint."
+  __slots__ = ("id", "name", "rank")
+
   def __init__(self, id, name, rank, downloads, tie):
     self.id = id
     self.name = name
@@ -418,22 +538,31 @@ class SearchResultAuthor(object):
 
 class ArticleDetails(Article):
   "Article info as returned by the article details endpoint."
+  __slots__ = ("url", "title", "collection", "posted", "doi", "abstract", "last_crawled", "ranks", "publication", "pub_doi", "repo")
+
   def __init__(self, article_id, connection):
     """Retrieves all required information for a single article.
 
     Arguments:
-      - article_id: The Rxivist ID of the article in question
+      - article_id: The Rxivist ID of the article in question, as it
+          was requested. (It's echoed back in the response as-is.)
       - connection: A database Connection object
 
     """
-    sql = """
-    SELECT a.url, a.title, a.collection, a.posted, a.doi,
-      a.abstract, p.publication, p.doi, a.repo
-      FROM articles a
-      LEFT JOIN article_publications AS p ON a.id=p.article
-      WHERE a.id=%s;
+    sql = f"""
+    SELECT articles.url, articles.title, articles.collection, articles.posted, articles.doi,
+      articles.abstract, p.publication, p.doi, articles.repo,
+      articles.last_crawled, {ArticleRanks.columns}
+      FROM articles
+      LEFT JOIN article_publications AS p ON articles.id=p.article
+      {ArticleRanks.joins}
+      WHERE articles.id=%s;
     """
-    sql_entry = connection.read(sql, (article_id,))
+    # the author list doesn't depend on the rest, so fetch both at once:
+    sql_entry, authors = connection.concurrently(
+      lambda: connection.read(sql, (article_id,)),
+      lambda: get_authors_bulk([int(article_id)], connection, True)
+    )
     if len(sql_entry) == 0:
       raise helpers.NotFoundError(article_id)
     sql_entry = sql_entry[0]
@@ -445,8 +574,9 @@ class ArticleDetails(Article):
     self.posted = sql_entry[3]
     self.doi = sql_entry[4]
     self.abstract = sql_entry[5]
-    self.ranks = ArticleRanks(self.id, connection)
-    self.get_authors(connection)
+    self.last_crawled = sql_entry[9]
+    self.ranks = ArticleRanks(self.id, connection, sql_entry[10:18])
+    self.authors = authors[int(article_id)]
     self.publication = sql_entry[6]
     self.pub_doi = sql_entry[7]
     self.repo = sql_entry[8]
@@ -454,9 +584,6 @@ class ArticleDetails(Article):
     if self.collection is None:
       self.collection = "unknown"
 
-    for author in self.authors:
-      author.GetBasicInfo(connection)
-
   def json(self):
     resp = {
       "id": self.id,
@@ -485,20 +612,32 @@ class AuthorArticle(Article):
   Less data than ArticleDetails class.
 
   """
-  def __init__(self, article_id, connection):
+  __slots__ = ("url", "title", "collection", "posted", "doi", "ranks")
+
+  def __init__(self, article_id, connection, sql_entry=None):
     """Retrieves all required information for a single article.
 
     Arguments:
       - article_id: The Rxivist ID of the article in question
       - connection: A database Connection object
+      - sql_entry: (Optionally) the article's url, title, collection, posted
+          date and DOI, followed by the values of ArticleRanks.columns, if
+          they were already fetched by a query covering several articles.
 
     """
 
-    sql = "SELECT url, title, collection, posted, doi FROM articles WHERE articles.id=%s"
-    sql_entry = connection.read(sql, (article_id,))
-    if len(sql_entry) == 0:
-      raise helpers.NotFoundError(article_id)
-    sql_entry = sql_entry[0]
+    if sql_entry is None:
+      sql = f"""
+        SELECT articles.url, articles.title, articles.collection,
+          articles.posted, articles.doi, {ArticleRanks.columns}
+        FROM articles
+        {ArticleRanks.joins}
+        WHERE articles.id=%s
+      """
+      sql_entry = connection.read(sql, (article_id,))
+      if len(sql_entry) == 0:
+        raise helpers.NotFoundError(article_id)
+      sql_entry = sql_entry[0]
 
     self.id = article_id
     self.url = sql_entry[0]
@@ -506,7 +645,7 @@ class AuthorArticle(Article):
     self.collection = sql_entry[2]
     self.posted = sql_entry[3]
     self.doi = sql_entry[4]
-    self.ranks = ArticleRanks(self.id, connection)
+    self.ranks = ArticleRanks(self.id, connection, sql_entry[5:13])
 
     if self.collection is None:
       self.collection = "unknown"
@@ -0,0 +1,88 @@
+"""Reporting of the database work done for each request.
+
+db.Connection tallies the queries sent during every request in a
+db.QueryProfile. The functions here report that tally: in a
+Server-Timing header, in a "debug" block added to JSON responses for
+requests that ask for one, and in the log for requests that were slow.
+"""
+import functools
+
+import bottle
+
+import config
+import helpers
+
+def debug_requested(kind="queries"):
+  """Determines whether the current request asked for debugging output:
+  by default, the breakdown of its queries added to the response.
+
+  Arguments:
+    - kind: The value the config.profiling["debug_parameter"] query
+        parameter has to be set to, such as "server" for the server
+        health endpoint.
+
+  """
+  param = config.profiling["debug_parameter"]
+  if not config.profiling["enabled"] or param is None:
+    return False
+  return bottle.request.query.get(param) == kind
+
+def server_timing(summary):
+  """Builds a Server-Timing header reporting time spent in the database
+  and on the request as a whole.
+
+  Arguments:
+    - summary: The request's QueryProfile.summary()
+
+  Returns:
+    - The value of the header
+
+  """
+  desc = f'{summary["queries"]} queries, {summary["rows"]} rows'
+  return f'db;dur={summary["db_ms"]};desc="{desc}", total;dur={summary["request_ms"]}'
+
+def report(profile):
+  """Reports a finished request's queries: sets the Server-Timing header
+  and logs the request if it was slow.
+
+  Arguments:
+    - profile: The QueryProfile returned by Connection.end_request()
+
+  """
+  if profile is None:
+    return
+  summary = profile.summary()
+  if config.profiling["server_timing"]:
+    bottle.response.set_header("Server-Timing", server_timing(summary))
+  if summary["request_ms"] < config.profiling["slow_request_ms"]:
+    return
+  query = bottle.request.query_string
+  print(f'SLOW REQUEST: {bottle.request.method} {bottle.request.path}{"?" + query if query else ""} took {summary["request_ms"]} ms ({summary["queries"]} queries, {summary["db_ms"]} ms in the database, {summary["rows"]} rows)')
+  for shape in summary["shapes"]:
+    print(f'  {shape["count"]}x, {shape["total_ms"]} ms total, {shape["slowest_ms"]} ms max, {shape["rows"]} rows: {shape["query"]}')
+
+def plugin(callback, connection):
+  """Bottle plugin that adds the query breakdown to serialized JSON
+  objects, for requests that ask for it (see debug_requested()).
+
+  Arguments:
+    - callback: The route being wrapped
+    - connection: The db.Connection the routes send their queries through
+
+  """
+  @functools.wraps(callback)
+  def wrapper(*args, **kwargs):
+    body = callback(*args, **kwargs)
+    if not isinstance(body, bytes) or not debug_requested():
+      return body
+    if not bottle.response.content_type.startswith("application/json"):
+      return body
+    profile = connection.profile()
+    body = body.rstrip()
+    if profile is None or not body.startswith(b"{") or not body.endswith(b"}"):
+      return body
+    debug = b'"debug":' + helpers.json_dumps(profile.summary())
+    if body != b"{}":
+      debug = b"," + debug
+    return body[:-1] + debug + b"}"
+  return wrapper
@@ -37,9 +37,27 @@ perform_ranks = {
   "month": True,
   "authors": True,
   "article_categories": True,
-  "author_categories": True
+  "author_categories": True,
+  "twitter": True, # call refresh_twitter_ranks() after fetching Crossref data
+  # If True, the "alltime" and "authors" rankings are brought up to date by
+  # calling refresh_ranks_incremental() (see db/migrations/006_incremental_ranks.sql),
+  # which only re-ranks papers whose download stats changed since the last
+  # run, and their authors. Set to False to rebuild them from scratch.
+  "incremental": True,
+  # If True, rankings that are rebuilt from scratch are written to a copy of
+  # the ranking table created by begin_rank_build() and swapped in by
+  # finish_rank_build() (see db/migrations/007_rank_builds.sql), so the API
+  # never reads a partially built ranking.
+  "shadow_tables": True
 }
 
+# Whether to call bump_data_version() once a run has finished updating
+# rankings or Crossref stats. The API watches the data_version table
+# and throws out its cached responses when the number changes. (Without
+# this, the API's caches only catch up after data_version["max_age"]
+# seconds; see the API's config.py.)
+bump_data_version = True
+
 # Information about how to connect to a postgres database will
 # all the Rxivist data
 db = {
@@ -0,0 +1,282 @@
+"""Shared fixtures for the API's tests.
+
+The tests never talk to a real database: psycopg2.connect is replaced with
+a FakeDatabase, which answers each query with whatever rows the test
+registered for it and records every statement it was sent. Everything
+above psycopg2 (the connection pool, prepared statements, the caches and
+the Bottle app itself) is the real thing.
+"""
+import datetime
+import decimal
+import io
+import json
+import os
+import re
+import sys
+import threading
+
+# config.py reads the database credentials from the environment
+os.environ.setdefault("RX_DBHOST", "localhost")
+os.environ.setdefault("RX_DBUSER", "rxivist")
+os.environ.setdefault("RX_DBPASSWORD", "rxivist")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bottle
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+import cache
+import config
+import db
+
+class FakeDatabase(object):
+  """Stands in for Postgres. Tests register the rows each query should
+  return with respond(), and every statement sent is recorded in
+  self.statements."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    """Forgets every registered response and recorded statement."""
+    self.handlers = []
+    self.statements = [] # (SQL, parameters)
+    self.cursors = [] # the arguments each cursor was opened with
+    self.generation = 1
+
+  def respond(self, pattern, rows):
+    """Answers queries matching a regular expression. Responses registered
+    later take precedence over earlier ones.
+
+    Arguments:
+      - pattern: A regular expression searched for in each query
+      - rows: The list of tuples to return, or a function that takes the
+          query's parameters and returns them
+
+    """
+    self.handlers.insert(0, (re.compile(pattern, re.S), rows))
+
+  def answer(self, query, params):
+    """Records a query and finds the rows it should return."""
+    with self.lock:
+      self.statements.append((query, params))
+    if "FROM data_version" in query:
+      return [(self.generation, None)]
+    for pattern, rows in self.handlers:
+      if pattern.search(query):
+        return list(rows(params) if callable(rows) else rows)
+    return []
+
+  def sent(self, pattern):
+    """Lists the recorded queries that match a regular expression."""
+    with self.lock:
+      return [s for s in self.statements if re.search(pattern, s[0], re.S)]
+
+  def connect(self, *args, **kwargs):
+    return FakeConnection(self)
+
+class FakeConnection(object):
+  """The parts of a psycopg2 connection (or db.PreparingConnection) the
+  API uses."""
+
+  def __init__(self, database):
+    self.database = database
+    self.prepared = set()
+    self.statements = {} # prepared statement name -> SQL
+    self.closed = 0
+    self.status = psycopg2.extensions.STATUS_READY
+    self.autocommit = True
+
+  def set_session(self, autocommit=None, **kwargs):
+    self.autocommit = autocommit
+
+  def cursor(self, name=None, **kwargs):
+    with self.database.lock:
+      self.database.cursors.append(dict(kwargs, name=name))
+    return FakeCursor(self)
+
+  def rollback(self):
+    pass
+
+  def commit(self):
+    pass
+
+  def close(self):
+    self.closed = 1
+
+class FakeCursor(object):
+  """A cursor that gets its results from the FakeDatabase. Prepared
+  statements are answered as if the SQL they were prepared from had been
+  sent."""
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.rows = []
+    self.itersize = 2000
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def execute(self, query, params=None):
+    prepare = re.match(r"PREPARE (\w+) AS (.*)", query, re.S)
+    if prepare is not None:
+      self.connection.statements[prepare.group(1)] = prepare.group(2)
+      self.rows = []
+      return
+    execute = re.match(r"EXECUTE (\w+)", query)
+    if execute is not None:
+      query = self.connection.statements[execute.group(1)]
+    self.rows = self.connection.database.answer(query, params)
+
+  def fetchall(self):
+    rows, self.rows = self.rows, []
+    return rows
+
+  def __iter__(self):
+    return iter(self.fetchall())
+
+  def close(self):
+    pass
+
+class Response(object):
+  "A response from the app, as returned by the client fixture."
+  def __init__(self, status, headers, body):
+    self.status = int(status.split(" ")[0])
+    self.headers = headers
+    self.body = body
+
+  def header(self, name):
+    """Looks up a response header, ignoring case (Bottle sends "ETag" as
+    "Etag", for example). Returns None if it wasn't sent."""
+    for key, value in self.headers.items():
+      if key.lower() == name.lower():
+        return value
+    return None
+
+  def json(self):
+    return json.loads(self.body)
+
+# The app opens its connection pool as soon as main.py is imported, so
+# the fake has to be in place for the whole session.
+DATABASE = FakeDatabase()
+psycopg2.connect = DATABASE.connect
+# (main.py also starts the web server when it's imported)
+bottle.run = lambda *args, **kwargs: None
+
+@pytest.fixture
+def database():
+  """The FakeDatabase, with no registered responses and empty caches."""
+  DATABASE.reset()
+  cache.responses.clear()
+  for memo in cache.memos:
+    memo.clear()
+  cache.data_version.generation = None
+  cache.data_version.checked = 0
+  yield DATABASE
+
+@pytest.fixture
+def connection(database):
+  "A Connection whose pool is filled with fake connections."
+  yield db.Connection(config.db["host"], config.db["db"], config.db["user"], config.db["password"])
+
+@pytest.fixture
+def profile(connection):
+  """Runs the test inside a simulated request on the connection, and
+  returns the QueryProfile counting the queries it sends."""
+  connection.begin_request()
+  profile = connection.profile()
+  yield profile
+  connection.end_request()
+
+@pytest.fixture
+def client(database):
+  """Sends requests to the Bottle app. Returns a function that takes a
+  path, a query string and a dict of headers, and returns a Response.
+  With stream=True, the response body is left as the iterable returned
+  by the app, which the test has to close."""
+  import main
+  app = bottle.default_app()
+
+  def get(path, query="", headers=None, stream=False):
+    environ = {
+      "REQUEST_METHOD": "GET",
+      "PATH_INFO": path,
+      "QUERY_STRING": query,
+      "SERVER_NAME": "localhost",
+      "SERVER_PORT": "80",
+      "SERVER_PROTOCOL": "HTTP/1.1",
+      "wsgi.url_scheme": "http",
+      "wsgi.input": io.BytesIO(),
+      "wsgi.errors": sys.stderr,
+    }
+    for name, value in (headers or {}).items():
+      environ["HTTP_" + name.upper().replace("-", "_")] = value
+    result = {}
+    def start_response(status, headers, exc_info=None):
+      result["status"] = status
+      result["headers"] = dict(headers)
+    body = app(environ, start_response)
+    if not stream:
+      body = b"".join(body)
+    return Response(result["status"], result["headers"], body)
+  return get
+
+# Rows for the most common queries, registered by the fixtures below.
+
+AUTHORS_PER_PAPER = 3
+
+@pytest.fixture
+def ranked_papers(database):
+  """Registers a ranking of 1,000 papers, each with AUTHORS_PER_PAPER
+  authors, and no tweets."""
+  def page(params):
+    size = params[-1] # (page 0, so LIMIT is the last parameter)
+    return [
+      (5000 - i, i, f"https://www.biorxiv.org/{i}", f"Paper {i}", "abstract", "genomics",
+        datetime.date(2020, 1, 1), f"10.1101/{i}", "biorxiv", i + 1, 1000)
+      for i in range(size)
+    ]
+  database.respond(r"SELECT COUNT\(DISTINCT a.id\)", [(1000,)])
+  database.respond(r"LIMIT", page)
+  database.respond(r"FROM article_authors as aa", lambda params: [
+    (article, article * 10 + n, f"Author {article}-{n}", "", "")
+    for article in sorted(params[0])
+    # (returned in reverse, to check that the recorded order is kept)
+    for n in reversed(range(AUTHORS_PER_PAPER))
+  ])
+  database.respond(r"SELECT \(SELECT COUNT", [(0, 0)])
+
+@pytest.fixture
+def monthly_totals(database):
+  """Registers the monthly totals used by the summary endpoint, both in
+  the monthly_stats table and as they're added up without it."""
+  months = [(repo, month, 2020) for repo in ["biorxiv", "medrxiv"] for month in range(1, 13)]
+  database.respond(r"FROM monthly_stats", [m + (100, 1000) for m in months])
+  database.respond(r"MAX\(posted\)", [(2020, 12)])
+  database.respond(r"AS submissions", [m + (100,) for m in months])
+  database.respond(r"AS downloads", [m + (1000,) for m in months])
+
+@pytest.fixture
+def site_tallies(database):
+  "Registers the tallies behind the data hygiene report."
+  database.respond(r"FROM articles;", [(1000, 3, 2, 1)])
+  database.respond(r"FROM authors;", [(5000,)])
+  # papers without a collection are grouped under NULL:
+  database.respond(r"GROUP BY collection", [("genomics", 12), ("zoology", 3), (None, 1)])
+  database.respond(r"article_authors w", [(decimal.Decimal(4),)])
+  database.respond(r"article_authors z", [(0,)])
+
+@pytest.fixture
+def export_rows(database):
+  "Registers two papers for the bulk export to read."
+  database.respond(r"json_agg", [
+    (i, f"10.1101/{i}", f"Paper {i}", f"https://www.biorxiv.org/{i}", "biorxiv", "genomics",
+      datetime.date(2020, 1, i), "abstract", i, 100 - i, i, 50 - i, None, None, i,
+      [{"id": 10 * i, "name": f"Author {i}"}])
+    for i in [1, 2]
+  ])
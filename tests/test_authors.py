@@ -0,0 +1,51 @@
+"""Tests for the author details endpoint."""
+import datetime
+
+import pytest
+
+import endpoints
+import models
+
+PAPER_COUNT = 300
+
+def _article(i):
+  """The url, title, collection, posted date and DOI of a synthetic paper,
+  followed by its ranks (see models.ArticleRanks.columns)."""
+  return (
+    f"https://www.biorxiv.org/{i}", f"Paper {i}", None if i % 50 == 0 else "genomics",
+    datetime.date(2015 + i % 5, 1 + i % 12, 1), f"10.1101/{i}",
+    i + 1, i + 2, None if i % 7 == 0 else i + 3, i // 2, "genomics",
+    10000 - i, 500 - i, None if i % 7 == 0 else 30,
+  )
+
+@pytest.fixture
+def prolific_author(database):
+  """Registers an author (ID 42) with PAPER_COUNT papers, each ranked in
+  every category, and returns the author's ID."""
+  database.respond(r"FROM authors WHERE id", [("Dr. Prolific", "The Institute", "")])
+  database.respond(r"WHERE article_authors.author=%s", [(i,) + _article(i) for i in range(PAPER_COUNT)])
+  # (papers can also be looked up one at a time, as they used to be:)
+  database.respond(r"WHERE articles.id=%s", lambda params: [_article(params[0])])
+  database.respond(r"FROM author_ranks WHERE", [(12, False, 999999)])
+  database.respond(r"FROM author_ranks_category", [(3, True, 888888, "genomics"), (40, False, 1000, "zoology")])
+  return 42
+
+def test_author_details_query_count(prolific_author, connection, profile):
+  author = endpoints.author_details(prolific_author, connection)
+  assert len(author.articles) == PAPER_COUNT
+  # the author's vitals, all of their papers (with ranks), and two
+  # lookups of the author's own ranks:
+  assert profile.queries == 4
+
+def test_author_details_unchanged(prolific_author, connection, profile):
+  author = endpoints.author_details(prolific_author, connection)
+  sent = profile.queries
+
+  # build the same response the old way, one paper at a time:
+  expected = models.Author(prolific_author)
+  expected.GetInfo(connection)
+  expected.articles = [models.AuthorArticle(a.id, connection) for a in author.articles]
+  assert profile.queries - sent > PAPER_COUNT
+
+  assert author.json() == expected.json()
+  assert author.json()["articles"][0]["category"] == "unknown"
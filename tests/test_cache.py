@@ -0,0 +1,95 @@
+"""Tests for response caching, ETags and their invalidation."""
+import time
+
+import cache
+import config
+
+def test_memo_expires(monkeypatch):
+  memo = cache.Memo(10)
+  memo.put("key", "value")
+  assert memo.get("key") == "value"
+  now = time.time()
+  monkeypatch.setattr(time, "time", lambda: now + config.data_version["max_age"] + 1)
+  assert memo.get("key") is None
+
+def test_new_generation_clears_caches(database, client, monthly_totals):
+  first = client("/v1/data/summary")
+  cache.counts.put("key", 5)
+  sent = len(database.statements)
+  client("/v1/data/summary")
+  assert len(database.statements) == sent # cached
+
+  database.generation += 1
+  cache.data_version.checked = 0 # (don't wait for the next poll)
+  second = client("/v1/data/summary")
+  assert len(database.sent(r"AS downloads")) == 2
+  assert cache.counts.get("key") is None
+  assert second.header("ETag") != first.header("ETag")
+
+def test_etag_expires(database, client, monkeypatch, monthly_totals):
+  now = time.time()
+  first = client("/v1/data/summary")
+  resp = client("/v1/data/summary", headers={"If-None-Match": first.header("ETag")})
+  assert resp.status == 304
+
+  # without a new generation, the ETag still changes once max_age passes:
+  monkeypatch.setattr(time, "time", lambda: now + config.data_version["max_age"])
+  resp = client("/v1/data/summary", headers={"If-None-Match": first.header("ETag")})
+  assert resp.status == 200
+  assert resp.header("ETag") != first.header("ETag")
+
+def test_etag_gzip(database, client, ranked_papers):
+  gzip = {"Accept-Encoding": "gzip"}
+  first = client("/v2/papers", "metric=downloads&page_size=20", gzip)
+  assert first.header("Content-Encoding") == "gzip"
+  tag = first.header("ETag")
+  assert tag.endswith('-gzip"')
+
+  resp = client("/v2/papers", "metric=downloads&page_size=20", dict(gzip, **{"If-None-Match": tag}))
+  assert resp.status == 304
+  assert resp.header("ETag") == tag
+
+  # a client that can't take gzip any more doesn't have the response it
+  # would be sent:
+  resp = client("/v2/papers", "metric=downloads&page_size=20", {"If-None-Match": tag})
+  assert resp.status == 200
+  assert resp.header("Content-Encoding") is None
+  assert resp.header("ETag") != tag
+
+def test_etag_too_small_to_compress(database, client):
+  database.respond(r"FROM article_traffic", [(1, 2020, 10, 100)])
+  gzip = {"Accept-Encoding": "gzip"}
+  first = client("/v1/downloads/123", "", gzip)
+  assert first.header("Content-Encoding") is None
+  resp = client("/v1/downloads/123", "", dict(gzip, **{"If-None-Match": first.header("ETag")}))
+  assert resp.status == 304
+  assert resp.header("ETag") == first.header("ETag")
+
+def test_etag_from_generation_read(database, client, monthly_totals):
+  def downloads(params):
+    # another request notices new data while this one is being answered:
+    database.generation = 2
+    cache.data_version.generation = 2
+    return [(repo, month, 2020, 1000) for repo in ["biorxiv", "medrxiv"] for month in range(1, 13)]
+  database.respond(r"AS downloads", downloads)
+  first = client("/v1/data/summary")
+  assert first.header("ETag").startswith('"1.')
+
+  # (and it wasn't cached as if it were built from the new data)
+  second = client("/v1/data/summary")
+  assert len(database.sent(r"AS downloads")) == 2
+  assert second.header("ETag").startswith('"2.')
+
+def test_not_modified_cache_control(database, client, monthly_totals):
+  first = client("/v1/data/summary")
+  assert first.header("Cache-Control") is not None
+  resp = client("/v1/data/summary", headers={"If-None-Match": first.header("ETag")})
+  assert resp.status == 304
+  assert resp.header("Cache-Control") == first.header("Cache-Control")
+
+  # if the header isn't known (after a restart, say), the full response
+  # is sent instead:
+  cache.cache_controls.clear()
+  resp = client("/v1/data/summary", headers={"If-None-Match": first.header("ETag")})
+  assert resp.status == 200
+  assert resp.header("Cache-Control") == first.header("Cache-Control")
@@ -0,0 +1,29 @@
+"""Tests for the bulk export endpoint."""
+import gzip
+import json
+
+import config
+
+def test_export(database, client, export_rows):
+  resp = client("/v1/export/papers")
+  assert resp.status == 200
+  papers = [json.loads(line) for line in gzip.decompress(resp.body).decode("utf-8").splitlines()]
+  assert [p["id"] for p in papers] == [1, 2]
+  assert papers[0]["authors"] == [{"id": 10, "name": "Author 1"}]
+  assert papers[1]["ranks"]["lastmonth"] == {"rank": None, "downloads": None}
+  # the rows come from a cursor that outlives its (committed) transaction:
+  assert [c["withhold"] for c in database.cursors if c["name"] is not None] == [True]
+
+def test_export_limit(database, client, export_rows):
+  running = [client("/v1/export/papers", stream=True) for _ in range(config.export["max_concurrent"])]
+  assert all(r.status == 200 for r in running)
+
+  resp = client("/v1/export/papers")
+  assert resp.status == 503
+  assert resp.header("Retry-After") == str(config.export["retry_after"])
+
+  # once one finishes (or its client goes away), another can start:
+  running[0].body.close()
+  assert client("/v1/export/papers").status == 200
+  for r in running[1:]:
+    r.body.close()
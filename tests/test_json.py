@@ -0,0 +1,46 @@
+"""Tests that the faster JSON encoders produce the same responses as the
+standard library's."""
+import decimal
+import json
+
+import pytest
+
+import cache
+import config
+import helpers
+
+ENCODERS = ["json", "orjson"]
+
+def _responses(client, monkeypatch, path, query=""):
+  "Requests the same page once with each encoder."
+  responses = []
+  for encoder in ENCODERS:
+    monkeypatch.setattr(config, "json_encoder", encoder)
+    cache.responses.clear()
+    for memo in cache.memos:
+      memo.clear()
+    responses.append(client(path, query))
+  return responses
+
+@pytest.mark.parametrize("path, query, rows", [
+  ("/v1/data/stats", "", "site_tallies"),
+  ("/v1/data/summary", "", "monthly_totals"),
+  ("/v2/papers", "metric=downloads&page_size=20", "ranked_papers"),
+])
+def test_encoders_match(database, client, monkeypatch, request, path, query, rows):
+  request.getfixturevalue(rows)
+  responses = _responses(client, monkeypatch, path, query)
+  assert [r.status for r in responses] == [200] * len(ENCODERS)
+  decoded = [r.json() for r in responses]
+  for other in decoded[1:]:
+    assert other == decoded[0]
+
+def test_null_keys(database, client, monkeypatch, site_tallies):
+  for resp in _responses(client, monkeypatch, "/v1/data/stats"):
+    assert resp.json()["outdated_count"] == {"genomics": 12, "zoology": 3, "null": 1}
+    assert resp.json()["missing_authors"] == 4
+
+@pytest.mark.parametrize("encoder", ENCODERS)
+def test_decimals(monkeypatch, encoder):
+  monkeypatch.setattr(config, "json_encoder", encoder)
+  assert json.loads(helpers.json_dumps({"a": decimal.Decimal("2"), "b": decimal.Decimal("2.5")})) == {"a": 2, "b": 2.5}
@@ -0,0 +1,73 @@
+"""Tests for the paper details endpoint."""
+import datetime
+
+import config
+import endpoints
+
+AUTHOR_COUNT = 40
+
+def _paper(database):
+  """Registers a paper (ID 123) with AUTHOR_COUNT authors."""
+  database.respond(r"LEFT JOIN article_publications", [(
+    "https://www.biorxiv.org/content/10.1101/123v1", "A consortium paper", "genomics",
+    datetime.date(2019, 5, 1), "10.1101/123", "The abstract", "Nature", "10.1038/123",
+    "biorxiv", datetime.datetime(2020, 1, 2, 3, 4, 5),
+    10, 20, 30, 4, "genomics", 5000, 400, 30,
+  )])
+  database.respond(r"FROM article_authors as aa", lambda params: [
+    (123, 1000 + i, f"Author {i}", "" if i % 2 else f"Institute {i}", None if i % 3 else f"0000-{i}")
+    for i in range(AUTHOR_COUNT)
+  ] if 123 in params[0] else [])
+
+def test_paper_details_query_count(database, connection, profile):
+  _paper(database)
+  paper = endpoints.paper_details("123", connection)
+  assert len(paper.authors) == AUTHOR_COUNT
+  # the article (with its publication and ranks), plus all its authors:
+  assert profile.queries == 2
+
+def test_paper_details_response(database, client):
+  _paper(database)
+  resp = client("/v1/papers/123")
+  assert resp.status == 200
+  # exactly what the endpoint returned before the author and rank
+  # lookups were combined:
+  assert resp.json() == {
+    "id": "123",
+    "doi": "10.1101/123",
+    "first_posted": "2019-05-01",
+    "repo": "biorxiv",
+    "biorxiv_url": "https://www.biorxiv.org/content/10.1101/123v1",
+    "url": f"{config.host}/v1/papers/123",
+    "title": "A consortium paper",
+    "category": "genomics",
+    "abstract": "The abstract",
+    "authors": [{
+      "id": 1000 + i,
+      "name": f"Author {i}",
+      "institution": None if i % 2 else f"Institute {i}",
+      "orcid": None if i % 3 else f"0000-{i}",
+    } for i in range(AUTHOR_COUNT)],
+    "ranks": {
+      "alltime": {"downloads": 5000, "rank": 10, "tie": False},
+      "ytd": {"downloads": 400, "rank": 20, "tie": False},
+      "lastmonth": {"downloads": 30, "rank": 30, "tie": False},
+      "category": {"downloads": 5000, "rank": 4, "tie": False},
+    },
+    "publication": {"journal": "Nature", "doi": "10.1038/123"},
+  }
+
+def test_paper_details_not_found(database, client):
+  resp = client("/v1/papers/456")
+  assert resp.status == 404
+
+def test_paper_downloads(database, client):
+  database.respond(r"FROM article_traffic", [(m, 2020, m * 10, m * 100) for m in range(1, 13)])
+  resp = client("/v1/downloads/123")
+  assert resp.status == 200
+  assert resp.header("Content-Type").startswith("application/json")
+  body = resp.json()
+  assert body["query"] == {"id": "123"}
+  assert body["results"][1] == {"month": 2, "year": 2020, "downloads": 20, "views": 200}
+  # a year or so of months is read in one go, not through a named cursor:
+  assert [c for c in database.cursors if c["name"] is not None] == []
@@ -0,0 +1,20 @@
+"""Tests for the per-request query breakdown."""
+import config
+
+def test_debug_off_by_default(database, client, ranked_papers):
+  resp = client("/v2/papers", "metric=downloads&debug=queries")
+  assert resp.status == 200
+  assert "debug" not in resp.json()
+
+def test_debug_parameter(database, client, monkeypatch, ranked_papers):
+  monkeypatch.setattr(config, "profiling", dict(config.profiling, debug_parameter="debug_secret"))
+  resp = client("/v2/papers", "metric=downloads&debug_secret=queries")
+  assert resp.json()["debug"]["queries"] == len(database.statements)
+
+def test_server_stats_hidden(database, client, monkeypatch):
+  assert client("/v1/data/server").status == 404
+  monkeypatch.setattr(config, "profiling", dict(config.profiling, debug_parameter="debug_secret"))
+  assert client("/v1/data/server", "debug_secret=queries").status == 404
+  resp = client("/v1/data/server", "debug_secret=server")
+  assert resp.status == 200
+  assert set(resp.json()) == {"pool", "cache", "rank_builds"}
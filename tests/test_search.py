@@ -0,0 +1,66 @@
+"""Tests for the paper search endpoint."""
+import pytest
+
+import config
+import helpers
+
+def _queries(database):
+  "Counts the queries sent, other than checks of the data version."
+  return len([s for s in database.statements if "data_version" not in s[0]])
+
+@pytest.mark.parametrize("page_size", [5, 250])
+def test_search_query_count(database, client, page_size, ranked_papers):
+  resp = client("/v2/papers", f"metric=downloads&page_size={page_size}")
+  assert resp.status == 200
+  results = resp.json()["results"]
+  assert len(results) == page_size
+  # one query for the page and one for every author on it, no matter
+  # how many papers that is:
+  assert _queries(database) == 2
+  assert [a["name"] for a in results[3]["authors"]] == ["Author 3-2", "Author 3-1", "Author 3-0"]
+
+def test_front_page_cached(database, client, ranked_papers):
+  first = client("/v2/papers")
+  assert first.status == 200
+  sent = _queries(database)
+  assert sent > 0
+
+  second = client("/v2/papers")
+  assert second.status == 200
+  assert second.body == first.body
+  assert _queries(database) == sent # answered from the response cache
+
+  # searches with parameters aren't cached:
+  client("/v2/papers", "metric=downloads")
+  assert _queries(database) > sent
+
+@pytest.mark.parametrize("values", [["1", 2], [[1], 2], [{"rank": 1}, 2], [1, None], [True, 2], [1], [1, 2, 3], [1.5, 2.7], [1.0, 2], [1, 2.5]])
+def test_invalid_cursor(database, client, values, ranked_papers):
+  cursor = helpers.encode_cursor("downloads", "alltime", "metric", values)
+  resp = client("/v2/papers", f"metric=downloads&cursor={cursor}")
+  assert resp.status == 400
+  assert len(database.sent(r"LIMIT")) == 0
+
+def test_relevance_cursor():
+  # relevance scores are the only sort key that isn't an integer
+  cursor = helpers.encode_cursor("downloads", "alltime", "relevance", [0.25, 2])
+  assert helpers.decode_cursor(cursor)[3] == [0.25, 2]
+  with pytest.raises(ValueError):
+    helpers.decode_cursor(helpers.encode_cursor("downloads", "alltime", "relevance", [0.25, 2.5]))
+
+def test_next_cursor(database, client, ranked_papers):
+  first = client("/v2/papers", "metric=downloads&page_size=10").json()
+  cursor = first["query"]["next_cursor"]
+  assert helpers.decode_cursor(cursor) == ("downloads", "alltime", "metric", [10, 9])
+  resp = client("/v2/papers", f"metric=downloads&page_size=10&cursor={cursor}")
+  assert resp.status == 200
+  assert database.sent(r"LIMIT")[-1][1][-3:] == (10, 9, 10)
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_search_vector(database, client, monkeypatch, indexed, ranked_papers):
+  monkeypatch.setattr(config, "search_vector_column", indexed)
+  resp = client("/v2/papers", "q=cancer&metric=downloads&sort=relevance")
+  assert resp.status == 200
+  sql = database.sent(r"LIMIT")[-1][0]
+  assert ("a.search_vector" in sql) == indexed
+  assert ("setweight(a.title_vector" in sql) != indexed
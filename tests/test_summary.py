@@ -0,0 +1,16 @@
+"""Tests for the monthly summary statistics."""
+import cache
+import config
+
+def test_rollup_off_by_default(database, client, monthly_totals):
+  assert client("/v1/data/summary").status == 200
+  assert database.sent(r"FROM monthly_stats") == []
+
+def test_summary_sources_match(database, client, monkeypatch, monthly_totals):
+  grouped = client("/v1/data/summary").json()
+
+  monkeypatch.setattr(config, "monthly_stats_table", True)
+  cache.responses.clear()
+  rollup = client("/v1/data/summary").json()
+  assert len(database.sent(r"FROM monthly_stats")) == 1
+  assert rollup == grouped